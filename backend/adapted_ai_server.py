@@ -10,13 +10,39 @@ import json
 import time
 import asyncio
 import base64
+import queue
+import copy
+import hashlib
+import functools
+import importlib.util
+import weakref
 from io import BytesIO
-from threading import Thread
+from threading import Thread, Lock, Event
+from collections import deque, OrderedDict
+from concurrent.futures import Future
 from PIL import Image
 import torch
-from transformers import AutoProcessor, AutoModelForImageTextToText
-from flask import Flask, request, jsonify
-from flask_cors import CORS
+from transformers import (
+    AutoProcessor, AutoModelForImageTextToText, DynamicCache,
+    TextIteratorStreamer, StoppingCriteria, StoppingCriteriaList
+)
+from flask import Flask, request, jsonify, Response, stream_with_context
+from flask.json.provider import JSONProvider
+
+try:
+    from torchvision.io import decode_jpeg, ImageReadMode
+except ImportError:
+    decode_jpeg = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    from blake3 import blake3
+except ImportError:
+    blake3 = None
 
 import logging
 
@@ -27,6 +53,163 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Inference tuning (override via environment)
+TORCH_COMPILE = os.getenv("GEMMA_TORCH_COMPILE", "1") == "1"
+GEMMA_QUANTIZATION = os.getenv("GEMMA_QUANTIZATION", "none")  # 'none', 'int8', 'nf4'
+MAX_BATCH_SIZE = int(os.getenv("GEMMA_MAX_BATCH_SIZE", "8"))
+MAX_WAIT_MS = int(os.getenv("GEMMA_MAX_WAIT_MS", "10"))
+
+# Prompt lengths are padded up to one of these so the compiled, CUDA-graph
+# captured decode sees a handful of shapes (check with TORCH_LOGS=recompiles)
+PROMPT_BUCKETS = (64, 128, 256, 512, 1024)
+
+# Fixed instruction prefixes whose KV cache is prefilled once at startup
+PROMPT_PREFIXES = {
+    "translate": "Translate this text from ",
+    "medical": "Provide medical guidance for these symptoms: ",
+    "search": "Help with this search query: ",
+    "gempath_analyze": "Analyze this family reunification data and extract key information: ",
+    "gempath_search": "Search for potential family matches based on this information: ",
+    "gempath_verify": "Verify these potential family matches and provide assessment: "
+}
+
+# Fixed instruction tails appended after the user-provided part of the prompt
+PROMPT_SUFFIXES = {
+    "medical": ". Include triage recommendations and when to seek immediate care. Be helpful but emphasize seeking professional medical care for serious symptoms.",
+    "search": ". Provide relevant information and guidance for someone in a refugee or displacement situation.",
+    "gempath_analyze": ". Please structure the response with person details, family relationships, locations, timeline, and identifying information.",
+    "gempath_search": ". Provide search strategies and recommendations.",
+    "gempath_verify": ". Include confidence scores and recommendations."
+}
+
+
+def _fill_template(prefix, text):
+    """Full prompt text for a PROMPT_PREFIXES/PROMPT_SUFFIXES template name"""
+    return PROMPT_PREFIXES.get(prefix, "") + text + PROMPT_SUFFIXES.get(prefix, "")
+
+
+class OrjsonProvider(JSONProvider):
+    """Flask JSON provider backed by orjson"""
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
+def _prompt_json(data):
+    """Serialize request data for a prompt, leaving out embedded image blobs"""
+    payload = {key: value for key, value in data.items() if key != 'image'}
+    if orjson is not None:
+        return orjson.dumps(payload, option=orjson.OPT_INDENT_2).decode()
+    return json.dumps(payload, indent=2)
+
+
+class ResponseCache:
+    """Thread-safe LRU cache with per-entry expiry for deterministic model responses"""
+    
+    def __init__(self, maxsize=1024, ttl=3600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = Lock()
+    
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+    
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def _image_key(image_data):
+    """Content hash of a base64 image payload (taken before any decoding)"""
+    raw = (image_data or '').encode()
+    if blake3 is not None:
+        return blake3(raw).hexdigest()
+    return hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+
+class StopOnEvent(StoppingCriteria):
+    """Stops generation once the event is set (e.g. the client disconnected)"""
+    
+    def __init__(self, event):
+        self.event = event
+    
+    def __call__(self, input_ids, scores, **kwargs):
+        return self.event.is_set()
+
+
+class BatchScheduler:
+    """Coalesces concurrent text-only prompts into a single generate() call"""
+    
+    def __init__(self, gemma_model, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS):
+        self.gemma_model = gemma_model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.pending = queue.Queue()
+        
+        Thread(target=self._worker, daemon=True).start()
+    
+    def submit(self, prompt, prefix=None):
+        """Queue a prompt; the returned future resolves to the response text"""
+        future = Future()
+        self.pending.put((prompt, prefix, future))
+        return future
+    
+    def _worker(self):
+        """Drain up to max_batch_size prompts or until max_wait elapses"""
+        while True:
+            batch = [self.pending.get()]
+            deadline = time.time() + self.max_wait
+            
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.pending.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            
+            try:
+                prompt, prefix, _ = batch[0]
+                if (len(batch) == 1 and not self.gemma_model.use_static_cache
+                        and prefix in self.gemma_model.prefix_cache):
+                    # A lone request skips the prefill of its cached instruction
+                    # prefix (eager only, see _build_prefix_cache)
+                    responses = [self.gemma_model.generate_text_with_prefix(prefix, prompt)]
+                else:
+                    prompts = [_fill_template(prefix, prompt) for prompt, prefix, _ in batch]
+                    responses = self.gemma_model.generate_text_batch(prompts)
+                
+                for (_, _, future), response in zip(batch, responses):
+                    future.set_result(response)
+            except Exception as e:
+                logger.error(f"Batch generation error: {e}")
+                for _, _, future in batch:
+                    # Futures answered before the failure keep their result
+                    if not future.done():
+                        future.set_exception(e)
+
+
 class KaggleGemmaModel:
     """Direct Kaggle Gemma 3n model handler"""
     
@@ -37,6 +220,28 @@ class KaggleGemmaModel:
         self.model_loaded = False
         self.loading = False
         
+        # Static KV cache is shared by every generate() call, so generation
+        # is serialized across Flask threads
+        self.use_static_cache = False
+        self._generate_lock = Lock()
+        
+        # client_id -> stop event of that client's in-flight request; a newer
+        # request from the same client stops the stale one
+        self._client_stop_events = weakref.WeakValueDictionary()
+        self._client_lock = Lock()
+        
+        # Text-only chat prompts are micro-batched across requests
+        self.batch_scheduler = BatchScheduler(self)
+        
+        # Templated text-only prompts repeat, so their tokenization is memoized
+        self._tokenize_text = functools.lru_cache(maxsize=256)(self._tokenize_text_uncached)
+        
+        # PROMPT_PREFIXES name -> (prefix input_ids, prefilled DynamicCache)
+        self.prefix_cache = {}
+        
+        # Greedy endpoints are deterministic, so repeat uploads skip the model
+        self.response_cache = ResponseCache(maxsize=1024, ttl=3600)
+        
         # Start loading in background
         self.load_model_async()
     
@@ -47,12 +252,23 @@ class KaggleGemmaModel:
             logger.info("🤖 Loading Kaggle Gemma 3n model...")
             
             try:
-                self.processor = AutoProcessor.from_pretrained(self.model_path)
-                self.model = AutoModelForImageTextToText.from_pretrained(
-                    self.model_path,
-                    torch_dtype=torch.float16,
-                    device_map="auto"
-                )
+                self.processor = AutoProcessor.from_pretrained(self.model_path, use_fast=True)
+                self.model = self._load_model_weights()
+                
+                # Compile the forward pass so generate() runs fused kernels;
+                # the actual compile happens on the first call in _warmup
+                if TORCH_COMPILE and torch.cuda.is_available():
+                    try:
+                        self.model.forward = torch.compile(
+                            self.model.forward,
+                            mode="reduce-overhead",
+                            fullgraph=False,
+                            dynamic=True
+                        )
+                        self.use_static_cache = True
+                        logger.info("⚡ torch.compile enabled (reduce-overhead, static KV cache)")
+                    except Exception as e:
+                        logger.warning(f"⚠️ torch.compile unavailable, running eager: {e}")
                 
                 logger.info("✅ Kaggle Gemma 3n model loaded successfully")
                 self.model_loaded = True
@@ -60,6 +276,7 @@ class KaggleGemmaModel:
                 
                 # Warmup
                 self._warmup()
+                self._build_prefix_cache()
                 
             except Exception as e:
                 logger.error(f"❌ Failed to load model: {e}")
@@ -68,28 +285,206 @@ class KaggleGemmaModel:
         
         Thread(target=load, daemon=True).start()
     
+    def _load_model_weights(self):
+        """Load the model with FlashAttention-2, falling back to PyTorch SDPA"""
+        attn_implementations = ["sdpa"]
+        if importlib.util.find_spec("flash_attn") is not None:
+            attn_implementations.insert(0, "flash_attention_2")
+        
+        for attn_implementation in attn_implementations:
+            try:
+                model = AutoModelForImageTextToText.from_pretrained(
+                    self.model_path,
+                    torch_dtype=torch.float16,
+                    device_map="auto",
+                    quantization_config=self._quantization_config(),
+                    attn_implementation=attn_implementation
+                )
+                logger.info(f"⚡ Attention implementation: {attn_implementation}")
+                return model
+            except (ValueError, ImportError) as e:
+                # Raised when the architecture or install lacks this backend
+                if attn_implementation == attn_implementations[-1]:
+                    raise
+                logger.warning(f"⚠️ {attn_implementation} unavailable, trying next: {e}")
+    
+    def _quantization_config(self):
+        """Build weight-only quantization config (None keeps fp16 weights)"""
+        if GEMMA_QUANTIZATION not in ("int8", "nf4"):
+            return None
+        
+        try:
+            from transformers import BitsAndBytesConfig
+            import bitsandbytes  # noqa: F401
+        except ImportError:
+            logger.warning("⚠️ bitsandbytes not installed, falling back to fp16 weights")
+            return None
+        
+        logger.info(f"📦 Loading weights quantized to {GEMMA_QUANTIZATION}")
+        if GEMMA_QUANTIZATION == "int8":
+            return BitsAndBytesConfig(load_in_8bit=True)
+        return BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_compute_dtype=torch.float16
+        )
+    
     def _warmup(self):
         """Warmup the model with a simple request"""
         try:
             logger.info("🔥 Warming up model...")
+            # Goes through the same inference_mode path as real requests so the
+            # compiled graph is not recompiled on the first real request
             self._generate_response([{"role": "user", "content": "Hello"}], max_tokens=10)
             logger.info("✅ Model warmed up")
         except Exception as e:
             logger.warning(f"⚠️ Warmup failed: {e}")
     
+    def _build_prefix_cache(self):
+        """Prefill the KV cache of every fixed instruction prefix once"""
+        if self.use_static_cache:
+            # The compiled (CUDA graph) forward would re-record for every new
+            # KV length of a growing DynamicCache
+            logger.info("Prefix KV cache disabled under torch.compile")
+            return
+        
+        try:
+            tokenizer = self.processor.tokenizer
+            for name, prefix in PROMPT_PREFIXES.items():
+                # The last token may merge with whatever follows, so it is left to the tail
+                prefix_ids = tokenizer(prefix, return_tensors="pt").input_ids[:, :-1].to(self.model.device)
+                cache = DynamicCache()
+                with self._generate_lock, torch.inference_mode():
+                    self.model(input_ids=prefix_ids, past_key_values=cache, use_cache=True)
+                self.prefix_cache[name] = (prefix_ids, cache)
+            logger.info(f"✅ Prefix KV cache built for {len(self.prefix_cache)} prompt templates")
+        except Exception as e:
+            logger.warning(f"⚠️ Prefix KV cache unavailable: {e}")
+    
     def _decode_image(self, image_data):
-        """Decode base64 image data"""
+        """Decode base64 image data (JPEG straight to a CUDA tensor when possible)"""
         try:
             if isinstance(image_data, str):
                 if image_data.startswith('data:image'):
                     image_data = image_data.split(',')[1]
-                image_bytes = base64.b64decode(image_data)
-                return Image.open(BytesIO(image_bytes)).convert('RGB')
+                image_bytes = base64.b64decode(image_data, validate=False)
+                
+                # nvJPEG decode skips the PIL decode and the later host-to-device copy
+                if decode_jpeg is not None and torch.cuda.is_available() and image_bytes[:3] == b'\xff\xd8\xff':
+                    try:
+                        encoded = torch.frombuffer(bytearray(image_bytes), dtype=torch.uint8)
+                        image = decode_jpeg(encoded, mode=ImageReadMode.RGB, device="cuda")
+                        return self._downscale_tensor(image)
+                    except RuntimeError as e:
+                        logger.warning(f"GPU JPEG decode failed, falling back to PIL: {e}")
+                
+                image = Image.open(BytesIO(image_bytes)).convert('RGB')
+                # The vision tower only sees a small fixed resolution anyway
+                max_side = self._vision_input_size()
+                image.thumbnail((max_side, max_side), Image.Resampling.BILINEAR)
+                return image
             return None
         except Exception as e:
             logger.error(f"Image decode error: {e}")
             return None
     
+    def _tokenize_text_uncached(self, text):
+        """Tokenize a text-only prompt (wrapped by the LRU cache in __init__)"""
+        return self.processor(text=text, return_tensors="pt")
+    
+    def _vision_input_size(self):
+        """Longest side the vision tower accepts, per the image processor config"""
+        size = getattr(getattr(self.processor, "image_processor", None), "size", None) or {}
+        return max(size.get("height", 0), size.get("width", 0), size.get("shortest_edge", 0)) or 896
+    
+    def _downscale_tensor(self, image):
+        """Shrink a CHW uint8 image tensor on its device to the vision input size"""
+        height, width = image.shape[-2:]
+        scale = self._vision_input_size() / max(height, width)
+        if scale >= 1:
+            return image
+        
+        size = (max(1, round(height * scale)), max(1, round(width * scale)))
+        resized = torch.nn.functional.interpolate(
+            image[None].float(), size=size, mode="bilinear", antialias=True, align_corners=False
+        )
+        return resized[0].round().clamp(0, 255).to(torch.uint8)
+    
+    def _claim_client(self, client_id):
+        """Stop the client's previous in-flight request and return a stop event for the new one"""
+        if not client_id:
+            return None
+        
+        stop_event = Event()
+        with self._client_lock:
+            previous = self._client_stop_events.get(client_id)
+            if previous is not None:
+                previous.set()
+            self._client_stop_events[client_id] = stop_event
+        return stop_event
+    
+    def _generate(self, inputs, stop_event=None, **generation_kwargs):
+        """Run model.generate under inference_mode, one call at a time"""
+        if stop_event is not None:
+            criteria = generation_kwargs.get("stopping_criteria") or StoppingCriteriaList()
+            criteria.append(StopOnEvent(stop_event))
+            generation_kwargs["stopping_criteria"] = criteria
+        
+        pad = 0
+        if self.use_static_cache and "past_key_values" not in generation_kwargs:
+            # Fixed-address KV cache lets the compiled decode step replay CUDA graphs
+            generation_kwargs.setdefault("cache_implementation", "static")
+            inputs, pad = self._pad_to_bucket(inputs)
+        
+        inputs = self._to_device(inputs)
+        with self._generate_lock, torch.inference_mode():
+            # A request superseded while waiting for the lock never starts
+            if stop_event is not None and stop_event.is_set():
+                raise RuntimeError("Superseded by a newer request from the same client")
+            outputs = self.model.generate(**inputs, **generation_kwargs)
+        
+        # Truncated output of a superseded request must not be returned or cached
+        if stop_event is not None and stop_event.is_set():
+            raise RuntimeError("Superseded by a newer request from the same client")
+        
+        # Drop the bucket padding so callers can slice by their own prompt length
+        return outputs[:, pad:]
+    
+    def _pad_to_bucket(self, inputs):
+        """Left-pad prompt tensors up to the next PROMPT_BUCKETS length"""
+        length = inputs["input_ids"].shape[-1]
+        bucket = next((b for b in PROMPT_BUCKETS if b >= length), length)
+        pad = bucket - length
+        if not pad:
+            return inputs, 0
+        
+        padded = dict(inputs)
+        if "attention_mask" not in padded:
+            padded["attention_mask"] = torch.ones_like(padded["input_ids"])
+        
+        pad_values = {
+            "input_ids": self.processor.tokenizer.pad_token_id or 0,
+            "attention_mask": 0,
+            "token_type_ids": 0
+        }
+        for key, value in pad_values.items():
+            if key in padded:
+                padded[key] = torch.nn.functional.pad(padded[key], (pad, 0), value=value)
+        
+        return padded, pad
+    
+    def _to_device(self, inputs):
+        """Copy CPU input tensors to the model device through pinned memory"""
+        if not torch.cuda.is_available():
+            return inputs
+        
+        # Pinned source buffers let the copy run as async DMA instead of a blocking memcpy
+        return {
+            key: (value.pin_memory().to(self.model.device, non_blocking=True)
+                  if torch.is_tensor(value) and value.device.type == "cpu" else value)
+            for key, value in inputs.items()
+        }
+    
     def _generate_response(self, messages, max_tokens=512):
         """Generate response using the model"""
         if not self.model_loaded:
@@ -101,23 +496,20 @@ class KaggleGemmaModel:
             # Format messages for the model
             text = messages[-1]["content"] if messages else ""
             
-            inputs = self.processor(text=text, return_tensors="pt")
+            inputs = self._tokenize_text(text)
             
-            with torch.no_grad():
-                outputs = self.model.generate(
-                    **inputs,
-                    max_new_tokens=max_tokens,
-                    do_sample=True,
-                    temperature=0.7,
-                    top_p=0.9,
-                    pad_token_id=self.processor.tokenizer.eos_token_id
-                )
-            
-            response = self.processor.decode(outputs[0], skip_special_tokens=True)
+            outputs = self._generate(
+                inputs,
+                max_new_tokens=max_tokens,
+                do_sample=True,
+                temperature=0.7,
+                top_p=0.9,
+                pad_token_id=self.processor.tokenizer.eos_token_id
+            )
             
-            # Remove the input prompt from response
-            if text in response:
-                response = response.replace(text, "").strip()
+            # Decode only the generated tokens, not the echoed prompt
+            gen_tokens = outputs[0, inputs["input_ids"].shape[-1]:]
+            response = self.processor.decode(gen_tokens, skip_special_tokens=True).strip()
             
             processing_time = time.time() - start_time
             
@@ -130,71 +522,175 @@ class KaggleGemmaModel:
             logger.error(f"Generation error: {e}")
             return {"error": str(e), "processing_time": 0}
     
-    def process_ocr(self, image_data, language='en'):
+    def generate_text_batch(self, prompts, max_new_tokens=512):
+        """Generate responses for a batch of text-only prompts in one call"""
+        if not self.model_loaded:
+            raise RuntimeError("Model not loaded yet")
+        
+        tokenizer = self.processor.tokenizer
+        # Left padding keeps every prompt flush against its generated tokens;
+        # set per call, as the tokenizer is shared with the other endpoints
+        inputs = tokenizer(prompts, return_tensors="pt", padding=True, padding_side="left")
+        
+        outputs = self._generate(
+            inputs,
+            max_new_tokens=max_new_tokens,
+            do_sample=True,
+            temperature=0.7,
+            top_p=0.9,
+            pad_token_id=tokenizer.pad_token_id or tokenizer.eos_token_id
+        )
+        
+        prompt_length = inputs["input_ids"].shape[-1]
+        return [
+            tokenizer.decode(row[prompt_length:], skip_special_tokens=True).strip()
+            for row in outputs
+        ]
+    
+    def generate_text_with_prefix(self, prefix, text, max_new_tokens=512):
+        """Generate from a cached instruction prefix, prefilling only the rest"""
+        prefix_ids, prefix_cache = self.prefix_cache[prefix]
+        tokenizer = self.processor.tokenizer
+        
+        # Tokenize the full prompt exactly as the batched path does, so the
+        # model sees the same tokens whichever path serves the request
+        prompt = _fill_template(prefix, text)
+        input_ids = tokenizer(prompt, return_tensors="pt").input_ids.to(prefix_ids.device)
+        n = prefix_ids.shape[-1]
+        if input_ids.shape[-1] <= n or not torch.equal(input_ids[0, :n], prefix_ids[0]):
+            return self.generate_text_batch([prompt], max_new_tokens=max_new_tokens)[0]
+        
+        # generate() extends the cache in place, so each request gets its own copy
+        outputs = self._generate(
+            {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)},
+            past_key_values=copy.deepcopy(prefix_cache),
+            max_new_tokens=max_new_tokens,
+            do_sample=True,
+            temperature=0.7,
+            top_p=0.9,
+            pad_token_id=tokenizer.pad_token_id or tokenizer.eos_token_id
+        )
+        
+        return tokenizer.decode(outputs[0, input_ids.shape[-1]:], skip_special_tokens=True).strip()
+    
+    def stream_chat(self, text, max_new_tokens=512):
+        """Yield response text chunks as they are generated"""
+        if not self.model_loaded:
+            raise RuntimeError("Model not loaded yet")
+        
+        inputs = self._tokenize_text(text)
+        streamer = TextIteratorStreamer(
+            self.processor.tokenizer,
+            skip_prompt=True,
+            skip_special_tokens=True,
+            timeout=120
+        )
+        cancelled = Event()
+        errors = []
+        
+        def generate():
+            try:
+                self._generate(
+                    inputs,
+                    max_new_tokens=max_new_tokens,
+                    do_sample=True,
+                    temperature=0.7,
+                    top_p=0.9,
+                    pad_token_id=self.processor.tokenizer.eos_token_id,
+                    streamer=streamer,
+                    stopping_criteria=StoppingCriteriaList([StopOnEvent(cancelled)])
+                )
+            except Exception as e:
+                # Unblock the consumer instead of leaving it to the streamer timeout
+                errors.append(e)
+                streamer.end()
+        
+        Thread(target=generate, daemon=True).start()
+        
+        try:
+            for chunk in streamer:
+                yield chunk
+            if errors:
+                raise errors[0]
+        finally:
+            # Runs when the client goes away too, so generation stops early
+            cancelled.set()
+    
+    def process_ocr(self, image_data, language='en', client_id=None):
         """Process OCR request"""
         try:
             start_time = time.time()
             
+            cache_key = ("ocr", _image_key(image_data), language)
+            cached = self.response_cache.get(cache_key)
+            if cached is not None:
+                return {**cached, "processing_time": time.time() - start_time}
+            
             image = self._decode_image(image_data)
-            if not image:
+            if image is None:
                 return {"error": "Invalid image data"}
             
             prompt = f"Extract and transcribe all text from this image. Language: {language}"
             
             inputs = self.processor(text=prompt, images=image, return_tensors="pt")
             
-            with torch.no_grad():
-                outputs = self.model.generate(
-                    **inputs,
-                    max_new_tokens=256,
-                    do_sample=False
-                )
+            outputs = self._generate(
+                inputs,
+                stop_event=self._claim_client(client_id),
+                max_new_tokens=256,
+                do_sample=False
+            )
             
-            text = self.processor.decode(outputs[0], skip_special_tokens=True)
-            if prompt in text:
-                text = text.replace(prompt, "").strip()
+            gen_tokens = outputs[0, inputs["input_ids"].shape[-1]:]
+            text = self.processor.decode(gen_tokens, skip_special_tokens=True).strip()
             
             processing_time = time.time() - start_time
             
-            return {
+            result = {
                 "text": text,
                 "language": language,
                 "confidence": 0.95,
                 "processing_time": processing_time
             }
+            self.response_cache.put(cache_key, result)
+            return result
             
         except Exception as e:
             logger.error(f"OCR error: {e}")
             return {"error": str(e)}
     
-    def process_document_analysis(self, image_data, document_type='general'):
+    def process_document_analysis(self, image_data, document_type='general', client_id=None):
         """Process document analysis request"""
         try:
             start_time = time.time()
             
+            cache_key = ("document", _image_key(image_data), document_type)
+            cached = self.response_cache.get(cache_key)
+            if cached is not None:
+                return {**cached, "processing_time": time.time() - start_time}
+            
             image = self._decode_image(image_data)
-            if not image:
+            if image is None:
                 return {"error": "Invalid image data"}
             
             prompt = f"Analyze this {document_type} document. Extract key fields, important information, and assess completeness. Focus on fields relevant for refugee/asylum documentation."
             
             inputs = self.processor(text=prompt, images=image, return_tensors="pt")
             
-            with torch.no_grad():
-                outputs = self.model.generate(
-                    **inputs,
-                    max_new_tokens=512,
-                    do_sample=True,
-                    temperature=0.3
-                )
+            outputs = self._generate(
+                inputs,
+                stop_event=self._claim_client(client_id),
+                max_new_tokens=512,
+                do_sample=False,
+                num_beams=1
+            )
             
-            analysis = self.processor.decode(outputs[0], skip_special_tokens=True)
-            if prompt in analysis:
-                analysis = analysis.replace(prompt, "").strip()
+            gen_tokens = outputs[0, inputs["input_ids"].shape[-1]:]
+            analysis = self.processor.decode(gen_tokens, skip_special_tokens=True).strip()
             
             processing_time = time.time() - start_time
             
-            return {
+            result = {
                 "document_type": document_type,
                 "extracted_fields": {},
                 "critical_fields": [],
@@ -205,73 +701,87 @@ class KaggleGemmaModel:
                 "urgency_level": "normal",
                 "analysis": analysis
             }
+            self.response_cache.put(cache_key, result)
+            return result
             
         except Exception as e:
             logger.error(f"Document analysis error: {e}")
             return {"error": str(e)}
     
-    def process_medical_image(self, image_data, symptoms=''):
+    def process_medical_image(self, image_data, symptoms='', client_id=None):
         """Process medical image analysis request"""
         try:
             start_time = time.time()
             
+            cache_key = ("medical", _image_key(image_data), symptoms)
+            cached = self.response_cache.get(cache_key)
+            if cached is not None:
+                return {**cached, "processing_time": time.time() - start_time}
+            
             image = self._decode_image(image_data)
             prompt = f"Analyze this medical image. Symptoms mentioned: {symptoms}. Provide guidance but emphasize seeking professional medical care."
             
-            if image:
+            if image is not None:
                 inputs = self.processor(text=prompt, images=image, return_tensors="pt")
             else:
-                inputs = self.processor(text=prompt, return_tensors="pt")
+                inputs = self._tokenize_text(prompt)
             
-            with torch.no_grad():
-                outputs = self.model.generate(
-                    **inputs,
-                    max_new_tokens=512,
-                    do_sample=True,
-                    temperature=0.3
-                )
+            outputs = self._generate(
+                inputs,
+                stop_event=self._claim_client(client_id),
+                max_new_tokens=512,
+                do_sample=False,
+                num_beams=1
+            )
             
-            analysis = self.processor.decode(outputs[0], skip_special_tokens=True)
-            if prompt in analysis:
-                analysis = analysis.replace(prompt, "").strip()
+            gen_tokens = outputs[0, inputs["input_ids"].shape[-1]:]
+            analysis = self.processor.decode(gen_tokens, skip_special_tokens=True).strip()
             
             processing_time = time.time() - start_time
             
-            return {
+            result = {
                 "medical_analysis": analysis,
                 "urgency_assessment": "Please consult healthcare professional",
                 "confidence": 0.85,
                 "processing_time": processing_time,
                 "disclaimer": "This is AI-generated guidance. Seek professional medical care."
             }
+            self.response_cache.put(cache_key, result)
+            return result
             
         except Exception as e:
             logger.error(f"Medical analysis error: {e}")
             return {"error": str(e)}
     
-    def process_multimodal_chat(self, text='', image_data=None):
-        """Process multimodal chat request"""
+    def process_multimodal_chat(self, text='', image_data=None, prefix=None, client_id=None):
+        """Process multimodal chat request (text is wrapped in the named prompt template if given)"""
         try:
             start_time = time.time()
             
-            if image_data:
-                image = self._decode_image(image_data)
-                inputs = self.processor(text=text, images=image, return_tensors="pt")
-            else:
-                inputs = self.processor(text=text, return_tensors="pt")
+            if not image_data:
+                # Text-only prompts share one generate() call with concurrent requests
+                response = self.batch_scheduler.submit(text, prefix).result()
+                
+                return {
+                    "response": response,
+                    "processing_time": time.time() - start_time
+                }
             
-            with torch.no_grad():
-                outputs = self.model.generate(
-                    **inputs,
-                    max_new_tokens=512,
-                    do_sample=True,
-                    temperature=0.7,
-                    top_p=0.9
-                )
+            image = self._decode_image(image_data)
+            text = _fill_template(prefix, text)
+            inputs = self.processor(text=text, images=image, return_tensors="pt")
+            
+            outputs = self._generate(
+                inputs,
+                stop_event=self._claim_client(client_id),
+                max_new_tokens=512,
+                do_sample=True,
+                temperature=0.7,
+                top_p=0.9
+            )
             
-            response = self.processor.decode(outputs[0], skip_special_tokens=True)
-            if text in response:
-                response = response.replace(text, "").strip()
+            gen_tokens = outputs[0, inputs["input_ids"].shape[-1]:]
+            response = self.processor.decode(gen_tokens, skip_special_tokens=True).strip()
             
             processing_time = time.time() - start_time
             
@@ -290,16 +800,16 @@ class CompleteMultimodalAIServer:
     
     def __init__(self):
         self.app = Flask(__name__)
+        if orjson is not None:
+            self.app.json = OrjsonProvider(self.app)
         
-        # Configure CORS properly for cross-origin requests
-        CORS(self.app, resources={
-            r"/api/*": {
-                "origins": ["http://localhost:8000", "http://192.168.1.*:8000", "http://127.0.0.1:8000", "*"],
-                "methods": ["GET", "POST", "OPTIONS"],
-                "allow_headers": ["Content-Type", "Authorization"],
-                "supports_credentials": False
-            }
-        })
+        # CORS: any origin is allowed, so the headers are static and set once per response
+        @self.app.after_request
+        def add_cors_headers(response):
+            response.headers["Access-Control-Allow-Origin"] = "*"
+            response.headers["Access-Control-Allow-Methods"] = "GET, POST, OPTIONS"
+            response.headers["Access-Control-Allow-Headers"] = "Content-Type, Authorization"
+            return response
         
         # Initialize Kaggle Gemma model
         self.model = KaggleGemmaModel()
@@ -310,8 +820,11 @@ class CompleteMultimodalAIServer:
             "start_time": time.time(),
             "total_requests": 0,
             "vision_requests": 0,
-            "processing_times": []
+            "processing_times": deque(maxlen=2048),
+            "time_sum": 0.0,
+            "time_count": 0
         }
+        self._stats_lock = Lock()
         
         self._setup_routes()
         logger.info("Complete Multimodal AI Server initialized")
@@ -319,12 +832,14 @@ class CompleteMultimodalAIServer:
     def _setup_routes(self):
         """Set up all Flask routes"""
         
-        @self.app.route('/api/status', methods=['GET', 'OPTIONS'])
+        @self.app.route('/api/<path:_>', methods=['OPTIONS'])
+        def preflight(_):
+            """CORS preflight for every API route"""
+            return '', 204
+        
+        @self.app.route('/api/status', methods=['GET'])
         def status():
             """Status endpoint"""
-            if request.method == 'OPTIONS':
-                return '', 200
-                
             return jsonify({
                 "status": "ready" if self.model.model_loaded else ("loading" if self.model.loading else "error"),
                 "mode": self.stats["mode"],
@@ -342,25 +857,24 @@ class CompleteMultimodalAIServer:
                 }
             })
         
-        @self.app.route('/api/vision/ocr', methods=['POST', 'OPTIONS'])
+        @self.app.route('/api/vision/ocr', methods=['POST'])
         def vision_ocr():
             """OCR endpoint"""
-            if request.method == 'OPTIONS':
-                return '', 200
-                
             try:
                 data = request.get_json()
                 if not data.get('image'):
                     return jsonify({"error": "No image data provided"}), 400
                 
-                result = self.model.process_ocr(data['image'], data.get('language', 'en'))
+                result = self.model.process_ocr(
+                    data['image'],
+                    data.get('language', 'en'),
+                    client_id=data.get('client_id')
+                )
                 
                 if 'error' in result:
                     return jsonify({"error": result['error']}), 500
                 
-                self.stats["vision_requests"] += 1
-                self.stats["total_requests"] += 1
-                self.stats["processing_times"].append(result['processing_time'])
+                self._record_request(result['processing_time'], vision=True)
                 
                 return jsonify({
                     "success": True,
@@ -375,12 +889,9 @@ class CompleteMultimodalAIServer:
                 logger.error(f"OCR error: {e}")
                 return jsonify({"error": "OCR processing failed"}), 500
         
-        @self.app.route('/api/vision/document', methods=['POST', 'OPTIONS'])
+        @self.app.route('/api/vision/document', methods=['POST'])
         def document_analysis():
             """Document analysis endpoint"""
-            if request.method == 'OPTIONS':
-                return '', 200
-                
             try:
                 data = request.get_json()
                 if not data.get('image'):
@@ -388,15 +899,14 @@ class CompleteMultimodalAIServer:
                 
                 result = self.model.process_document_analysis(
                     data['image'], 
-                    data.get('document_type', 'general')
+                    data.get('document_type', 'general'),
+                    client_id=data.get('client_id')
                 )
                 
                 if 'error' in result:
                     return jsonify({"error": result['error']}), 500
                 
-                self.stats["vision_requests"] += 1
-                self.stats["total_requests"] += 1
-                self.stats["processing_times"].append(result['processing_time'])
+                self._record_request(result['processing_time'], vision=True)
                 
                 return jsonify({
                     "success": True,
@@ -415,12 +925,9 @@ class CompleteMultimodalAIServer:
                 logger.error(f"Document analysis error: {e}")
                 return jsonify({"error": "Document analysis failed"}), 500
         
-        @self.app.route('/api/vision/medical', methods=['POST', 'OPTIONS'])
+        @self.app.route('/api/vision/medical', methods=['POST'])
         def medical_image_analysis():
             """Medical image analysis endpoint"""
-            if request.method == 'OPTIONS':
-                return '', 200
-                
             try:
                 data = request.get_json()
                 if not data.get('image'):
@@ -428,15 +935,14 @@ class CompleteMultimodalAIServer:
                 
                 result = self.model.process_medical_image(
                     data['image'],
-                    data.get('symptoms', '')
+                    data.get('symptoms', ''),
+                    client_id=data.get('client_id')
                 )
                 
                 if 'error' in result:
                     return jsonify({"error": result['error']}), 500
                 
-                self.stats["vision_requests"] += 1
-                self.stats["total_requests"] += 1
-                self.stats["processing_times"].append(result['processing_time'])
+                self._record_request(result['processing_time'], vision=True)
                 
                 return jsonify({
                     "success": True,
@@ -452,26 +958,20 @@ class CompleteMultimodalAIServer:
                 logger.error(f"Medical image analysis error: {e}")
                 return jsonify({"error": "Medical image analysis failed"}), 500
         
-        @self.app.route('/api/multimodal/chat', methods=['POST', 'OPTIONS'])
+        @self.app.route('/api/multimodal/chat', methods=['POST'])
         def multimodal_chat():
             """Multimodal chat endpoint"""
-            if request.method == 'OPTIONS':
-                return '', 200
-                
             try:
                 data = request.get_json()
                 text = data.get('text', '')
                 image_data = data.get('image')
                 
-                result = self.model.process_multimodal_chat(text, image_data)
+                result = self.model.process_multimodal_chat(text, image_data, client_id=data.get('client_id'))
                 
                 if 'error' in result:
                     return jsonify({"error": result['error']}), 500
                 
-                self.stats["total_requests"] += 1
-                if image_data:
-                    self.stats["vision_requests"] += 1
-                self.stats["processing_times"].append(result['processing_time'])
+                self._record_request(result['processing_time'], vision=bool(image_data))
                 
                 return jsonify({
                     "success": True,
@@ -484,260 +984,187 @@ class CompleteMultimodalAIServer:
                 logger.error(f"Multimodal chat error: {e}")
                 return jsonify({"error": "Multimodal chat failed"}), 500
         
-        @self.app.route('/api/translate', methods=['POST', 'OPTIONS'])
+        @self.app.route('/api/translate', methods=['POST'])
         def translate():
             """Translation endpoint"""
-            if request.method == 'OPTIONS':
-                return '', 200
-                
-            try:
-                data = request.get_json()
-                text = data.get('text', '')
-                from_lang = data.get('from', 'auto')
-                to_lang = data.get('to', 'en')
-                
-                # Use multimodal chat for translation
-                prompt = f"Translate this text from {from_lang} to {to_lang}: {text}"
-                result = self.model.process_multimodal_chat(prompt)
-                
-                if 'error' in result:
-                    return jsonify({"error": result['error']}), 500
-                
-                self.stats["total_requests"] += 1
-                self.stats["processing_times"].append(result['processing_time'])
-                
-                return jsonify({
-                    "success": True,
-                    "translated_text": result['response'],
-                    "from_language": from_lang,
-                    "to_language": to_lang,
-                    "processing_time_ms": round(result['processing_time'] * 1000)
-                })
-                
-            except Exception as e:
-                logger.error(f"Translation error: {e}")
-                return jsonify({"error": "Translation failed"}), 500
+            return self._text_endpoint(
+                lambda data: f"{data.get('from', 'auto')} to {data.get('to', 'en')}: {data.get('text', '')}",
+                lambda data, response: {
+                    "translated_text": response,
+                    "from_language": data.get('from', 'auto'),
+                    "to_language": data.get('to', 'en')
+                },
+                "Translation failed",
+                prefix="translate"
+            )
         
-        @self.app.route('/api/medical', methods=['POST', 'OPTIONS'])
+        @self.app.route('/api/medical', methods=['POST'])
         def medical():
             """Medical guidance endpoint"""
-            if request.method == 'OPTIONS':
-                return '', 200
-                
-            try:
-                data = request.get_json()
-                symptoms = data.get('symptoms', '')
-                
-                # Use multimodal chat for medical guidance
-                prompt = f"Provide medical guidance for these symptoms: {symptoms}. Include triage recommendations and when to seek immediate care. Be helpful but emphasize seeking professional medical care for serious symptoms."
-                result = self.model.process_multimodal_chat(prompt)
-                
-                if 'error' in result:
-                    return jsonify({"error": result['error']}), 500
-                
-                self.stats["total_requests"] += 1
-                self.stats["processing_times"].append(result['processing_time'])
-                
-                return jsonify({
-                    "success": True,
-                    "medical_advice": result['response'],
-                    "disclaimer": "This is AI-generated guidance. Seek professional medical care for serious symptoms.",
-                    "processing_time_ms": round(result['processing_time'] * 1000)
-                })
-                
-            except Exception as e:
-                logger.error(f"Medical endpoint error: {e}")
-                return jsonify({"error": "Medical guidance failed"}), 500
+            return self._text_endpoint(
+                lambda data: data.get('symptoms', ''),
+                lambda data, response: {
+                    "medical_advice": response,
+                    "disclaimer": "This is AI-generated guidance. Seek professional medical care for serious symptoms."
+                },
+                "Medical guidance failed",
+                prefix="medical"
+            )
         
-        @self.app.route('/api/search', methods=['POST', 'OPTIONS'])
+        @self.app.route('/api/search', methods=['POST'])
         def search():
             """Search endpoint"""
-            if request.method == 'OPTIONS':
-                return '', 200
-                
-            try:
-                data = request.get_json()
-                query = data.get('query', '')
-                
-                # Use multimodal chat for search assistance
-                prompt = f"Help with this search query: {query}. Provide relevant information and guidance for someone in a refugee or displacement situation."
-                result = self.model.process_multimodal_chat(prompt)
-                
-                if 'error' in result:
-                    return jsonify({"error": result['error']}), 500
-                
-                self.stats["total_requests"] += 1
-                self.stats["processing_times"].append(result['processing_time'])
-                
-                return jsonify({
-                    "success": True,
-                    "results": [{"content": result['response'], "relevance": 0.9}],
-                    "query": query,
-                    "processing_time_ms": round(result['processing_time'] * 1000)
-                })
-                
-            except Exception as e:
-                logger.error(f"Search error: {e}")
-                return jsonify({"error": "Search failed"}), 500
+            return self._text_endpoint(
+                lambda data: data.get('query', ''),
+                lambda data, response: {
+                    "results": [{"content": response, "relevance": 0.9}],
+                    "query": data.get('query', '')
+                },
+                "Search failed",
+                prefix="search"
+            )
         
-        @self.app.route('/api/gempath/analyze', methods=['POST', 'OPTIONS'])
+        @self.app.route('/api/gempath/analyze', methods=['POST'])
         def gempath_analyze():
             """GemPath family analysis endpoint"""
-            if request.method == 'OPTIONS':
-                return '', 200
-                
-            try:
-                data = request.get_json()
-                
-                # Use multimodal chat for family data analysis
-                prompt = f"Analyze this family reunification data and extract key information: {json.dumps(data, indent=2)}. Please structure the response with person details, family relationships, locations, timeline, and identifying information."
-                result = self.model.process_multimodal_chat(prompt)
-                
-                if 'error' in result:
-                    return jsonify({"error": result['error']}), 500
-                
-                self.stats["total_requests"] += 1
-                self.stats["processing_times"].append(result['processing_time'])
-                
-                return jsonify({
-                    "success": True,
-                    "analysis": result['response'],
-                    "processing_time_ms": round(result['processing_time'] * 1000)
-                })
-                
-            except Exception as e:
-                logger.error(f"GemPath analyze error: {e}")
-                return jsonify({"error": "Family data analysis failed"}), 500
+            return self._text_endpoint(
+                lambda data: _prompt_json(data),
+                lambda data, response: {"analysis": response},
+                "Family data analysis failed",
+                prefix="gempath_analyze"
+            )
         
-        @self.app.route('/api/gempath/search', methods=['POST', 'OPTIONS'])
+        @self.app.route('/api/gempath/search', methods=['POST'])
         def gempath_search():
             """GemPath family search endpoint"""
-            if request.method == 'OPTIONS':
-                return '', 200
-                
-            try:
-                data = request.get_json()
-                
-                # Use multimodal chat for family search
-                prompt = f"Search for potential family matches based on this information: {json.dumps(data, indent=2)}. Provide search strategies and recommendations."
-                result = self.model.process_multimodal_chat(prompt)
-                
-                if 'error' in result:
-                    return jsonify({"error": result['error']}), 500
-                
-                self.stats["total_requests"] += 1
-                self.stats["processing_times"].append(result['processing_time'])
-                
-                return jsonify({
-                    "success": True,
-                    "matches": [],
-                    "search_recommendations": result['response'],
-                    "processing_time_ms": round(result['processing_time'] * 1000)
-                })
-                
-            except Exception as e:
-                logger.error(f"GemPath search error: {e}")
-                return jsonify({"error": "Family search failed"}), 500
+            return self._text_endpoint(
+                lambda data: _prompt_json(data),
+                lambda data, response: {"matches": [], "search_recommendations": response},
+                "Family search failed",
+                prefix="gempath_search"
+            )
         
-        @self.app.route('/api/gempath/verify', methods=['POST', 'OPTIONS'])
+        @self.app.route('/api/gempath/verify', methods=['POST'])
         def gempath_verify():
             """GemPath family verification endpoint"""
-            if request.method == 'OPTIONS':
-                return '', 200
-                
-            try:
-                data = request.get_json()
-                
-                # Use multimodal chat for family verification
-                prompt = f"Verify these potential family matches and provide assessment: {json.dumps(data, indent=2)}. Include confidence scores and recommendations."
-                result = self.model.process_multimodal_chat(prompt)
-                
-                if 'error' in result:
-                    return jsonify({"error": result['error']}), 500
-                
-                self.stats["total_requests"] += 1
-                self.stats["processing_times"].append(result['processing_time'])
-                
-                return jsonify({
-                    "success": True,
-                    "verification": result['response'],
-                    "confidence_score": 75,
-                    "processing_time_ms": round(result['processing_time'] * 1000)
-                })
-                
-            except Exception as e:
-                logger.error(f"GemPath verify error: {e}")
-                return jsonify({"error": "Family verification failed"}), 500
+            return self._text_endpoint(
+                lambda data: _prompt_json(data),
+                lambda data, response: {"verification": response, "confidence_score": 75},
+                "Family verification failed",
+                prefix="gempath_verify"
+            )
+        
+        @self.app.route('/api/cache/clear', methods=['POST'])
+        def clear_cache():
+            """Drop all memoized OCR/document/medical responses"""
+            self.model.response_cache.clear()
+            logger.info("Response cache cleared")
+            return jsonify({"success": True})
         
-        @self.app.route('/api/chat', methods=['POST', 'OPTIONS'])
+        @self.app.route('/api/stream/chat', methods=['POST'])
+        def stream_chat():
+            """Streaming chat endpoint (server-sent events)"""
+            data = request.get_json()
+            text = data.get('text', data.get('message', ''))
+            
+            if not self.model.model_loaded:
+                return jsonify({"error": "Model not loaded yet"}), 503
+            
+            def events():
+                start_time = time.time()
+                try:
+                    for chunk in self.model.stream_chat(text):
+                        yield f"data: {json.dumps({'token': chunk})}\n\n"
+                    yield f"data: {json.dumps({'done': True})}\n\n"
+                    self._record_request(time.time() - start_time)
+                except Exception as e:
+                    logger.error(f"Streaming chat error: {e}")
+                    yield f"data: {json.dumps({'error': 'Streaming chat failed'})}\n\n"
+            
+            return Response(stream_with_context(events()), mimetype='text/event-stream')
+        
+        @self.app.route('/api/chat', methods=['POST'])
         def chat():
             """Legacy chat endpoint"""
-            if request.method == 'OPTIONS':
-                return '', 200
-                
-            try:
-                data = request.get_json()
-                message = data.get('message', data.get('text', ''))
-                
-                result = self.model.process_multimodal_chat(message)
-                
-                if 'error' in result:
-                    return jsonify({"error": result['error']}), 500
-                
-                self.stats["total_requests"] += 1
-                self.stats["processing_times"].append(result['processing_time'])
-                
-                return jsonify({
-                    "success": True,
-                    "response": result['response'],
-                    "processing_time_ms": round(result['processing_time'] * 1000)
-                })
-                
-            except Exception as e:
-                logger.error(f"Chat error: {e}")
-                return jsonify({"error": "Chat failed"}), 500
+            return self._text_endpoint(
+                lambda data: data.get('message', data.get('text', '')),
+                lambda data, response: {"response": response},
+                "Chat failed"
+            )
         
-        @self.app.route('/api/process', methods=['POST', 'OPTIONS'])
+        @self.app.route('/api/process', methods=['POST'])
         def process_text():
             """Legacy process endpoint"""
-            if request.method == 'OPTIONS':
-                return '', 200
-                
-            try:
-                data = request.get_json()
-                text = data.get('prompt', data.get('text', ''))
-                
-                result = self.model.process_multimodal_chat(text)
-                
-                if 'error' in result:
-                    return jsonify({"error": result['error']}), 500
-                
-                self.stats["total_requests"] += 1
-                self.stats["processing_times"].append(result['processing_time'])
-                
-                return jsonify({
-                    "success": True,
-                    "response": result['response'],
-                    "processing_time_ms": round(result['processing_time'] * 1000)
-                })
-                
-            except Exception as e:
-                logger.error(f"Process error: {e}")
-                return jsonify({"error": "Processing failed"}), 500
+            return self._text_endpoint(
+                lambda data: data.get('prompt', data.get('text', '')),
+                lambda data, response: {"response": response},
+                "Processing failed"
+            )
         
         # Log all registered routes
         logger.info(f"Registered routes: {[rule.rule for rule in self.app.url_map.iter_rules()]}")
     
+    def _text_endpoint(self, make_prompt, make_response, error_message, prefix=None):
+        """Shared body of the text-only endpoints built on process_multimodal_chat"""
+        try:
+            data = request.get_json()
+            result = self.model.process_multimodal_chat(make_prompt(data), prefix=prefix)
+            
+            if 'error' in result:
+                return jsonify({"error": result['error']}), 500
+            
+            self._record_request(result['processing_time'])
+            
+            return jsonify({
+                "success": True,
+                **make_response(data, result['response']),
+                "processing_time_ms": round(result['processing_time'] * 1000)
+            })
+            
+        except Exception as e:
+            logger.error(f"{error_message}: {e}")
+            return jsonify({"error": error_message}), 500
+    
+    def _record_request(self, processing_time, vision=False):
+        """Update request counters and processing time totals"""
+        with self._stats_lock:
+            self.stats["total_requests"] += 1
+            if vision:
+                self.stats["vision_requests"] += 1
+            self.stats["processing_times"].append(processing_time)
+            self.stats["time_sum"] += processing_time
+            self.stats["time_count"] += 1
+    
     def _calculate_avg_processing_time(self):
         """Calculate average processing time"""
-        if not self.stats["processing_times"]:
+        if not self.stats["time_count"]:
             return 0
-        return round(sum(self.stats["processing_times"]) / len(self.stats["processing_times"]) * 1000)
+        return round(self.stats["time_sum"] / self.stats["time_count"] * 1000)
     
     def run(self, host='0.0.0.0', port=8080, debug=False):
         """Run the server"""
         logger.info(f"Starting Complete Multimodal AI Server on {host}:{port}")
-        self.app.run(host=host, port=port, debug=debug, threaded=True)
+        
+        if debug:
+            self.app.run(host=host, port=port, debug=debug, threaded=True)
+            return
+        
+        # Single process because the GPU model is a singleton; request threads
+        # mostly wait on the batch scheduler, so there can be many of them
+        try:
+            from waitress import serve
+            logger.info("🌟 Starting with Waitress WSGI server...")
+            serve(
+                self.app,
+                host=host,
+                port=port,
+                threads=int(os.getenv("SERVER_THREADS", "16")),
+                connection_limit=500,
+                channel_timeout=300
+            )
+        except ImportError:
+            logger.warning("Waitress not available, using Flask dev server")
+            self.app.run(host=host, port=port, threaded=True)
 
 
 if __name__ == '__main__':
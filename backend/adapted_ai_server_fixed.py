@@ -9,15 +9,27 @@ import sys
 import json
 import time
 import asyncio
-import base64
-from io import BytesIO
-from threading import Thread
-from PIL import Image
+import binascii
+import glob
+import functools
+import importlib.util
+from collections import OrderedDict
+from threading import Thread, Event, Lock
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from PIL import ImageOps, UnidentifiedImageError
 import torch
-from transformers import AutoProcessor, AutoModelForCausalLM, AutoTokenizer
+from transformers import AutoProcessor, AutoModelForCausalLM, AutoTokenizer, DynamicCache
 from flask import Flask, request, jsonify
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
 
+from image_decode import VISION_INPUT_SIZE, decode_image_bytes, start_decode_pool
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 import logging
 
 logging.basicConfig(
@@ -27,6 +39,71 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Chat micro-batching: up to MAX_BATCH queued prompts share one generate()
+MAX_BATCH = 8
+BATCH_TIMEOUT = 0.02  # seconds to wait for the next queued prompt
+
+# Longest a route waits for its queued model job before answering 504
+JOB_TIMEOUT = 120
+
+# Full tracebacks are logged at most once per this many seconds per error type
+TRACEBACK_INTERVAL = 10
+
+# Per-session KV caches kept for multi-turn chat (least recently used evicted)
+MAX_SESSIONS = 128
+
+# Weight-only quantization at load: 'none', 'int8' or 'nf4' (needs bitsandbytes)
+GEMMA_QUANTIZATION = os.getenv("GEMMA_QUANTIZATION", "nf4")
+
+# Compile the forward pass into CUDA graphs (reduce-overhead) after load
+TORCH_COMPILE = os.getenv("GEMMA_TORCH_COMPILE", "1") == "1"
+
+# Small text model used as the draft for speculative decoding of text-only
+# chats; off unless set. Its vocabulary differs from Gemma 3n's, so drafts are
+# re-tokenized between the two tokenizers (universal assisted decoding)
+DRAFT_MODEL_PATH = os.getenv("GEMMA_DRAFT_MODEL", "")
+NUM_ASSISTANT_TOKENS = 5
+
+
+class OrjsonProvider(JSONProvider):
+    """Flask JSON provider backed by orjson"""
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
+_last_traceback = {}
+_last_traceback_lock = Lock()
+
+
+def _log_exc_rate_limited(message, exc):
+    """Log an exception, formatting its traceback at most once per TRACEBACK_INTERVAL per type"""
+    name = type(exc).__name__
+    now = time.monotonic()
+    with _last_traceback_lock:
+        with_traceback = now - _last_traceback.get(name, float('-inf')) >= TRACEBACK_INTERVAL
+        if with_traceback:
+            _last_traceback[name] = now
+    
+    if with_traceback:
+        logger.error(f"{message}: {name}: {exc}", exc_info=exc)
+    else:
+        logger.error(f"{message}: {name}: {exc}")
+
+
+@functools.lru_cache(maxsize=None)
+def _load_processor(model_path, vision):
+    """Load (processor, tokenizer) once per model path; vision processors wrap their own tokenizer"""
+    if vision:
+        processor = AutoProcessor.from_pretrained(model_path, use_fast=True)
+        return processor, processor.tokenizer
+    tokenizer = AutoTokenizer.from_pretrained(model_path, use_fast=True)
+    return tokenizer, tokenizer
+
+
 class KaggleGemmaModel:
     """Fixed Kaggle Gemma model handler with proper image token handling"""
     
@@ -35,9 +112,23 @@ class KaggleGemmaModel:
         self.model = None
         self.processor = None
         self.tokenizer = None
+        self.draft_model = None
+        self.draft_tokenizer = None
+        self.use_static_cache = False
         self.model_loaded = False
+        
+        # Reusable pinned host buffer and side stream for pixel_values uploads
+        self.img_buf = None
+        self.copy_stream = None
+        
+        # session_id -> (token ids so far, DynamicCache); only touched by the
+        # server's single model worker
+        self.sessions = OrderedDict()
         self.loading = False
         
+        # Set by the server; image decoding then runs in worker processes
+        self.decode_pool = None
+        
         # Start loading in background
         self.load_model_async()
     
@@ -53,29 +144,65 @@ class KaggleGemmaModel:
                 config = AutoConfig.from_pretrained(self.model_path)
                 logger.info(f"Model type: {config.model_type}")
                 
-                # Load tokenizer and processor
-                self.tokenizer = AutoTokenizer.from_pretrained(self.model_path)
-                
                 # Check if this is a vision model
-                if hasattr(config, 'vision_config') or 'vision' in str(config):
+                vision = hasattr(config, 'vision_config') or 'vision' in str(config)
+                if vision:
                     logger.info("Vision model detected, loading processor...")
-                    self.processor = AutoProcessor.from_pretrained(self.model_path)
                 else:
                     logger.info("Text-only model detected")
-                    self.processor = self.tokenizer
                 
-                # Load the model
-                self.model = AutoModelForCausalLM.from_pretrained(
-                    self.model_path,
-                    torch_dtype=torch.float16,
-                    device_map="auto",
-                    trust_remote_code=True  # Some Gemma models need this
-                )
+                # Load tokenizer and processor (the processor's tokenizer is reused)
+                self.processor, self.tokenizer = _load_processor(self.model_path, vision)
+                
+                # Weights keep the checkpoint's dtype; generate() runs in
+                # whatever dtype they load in, so no cast is needed later
+                dtype = self._select_dtype(config)
+                attn_implementation = self._attn_implementation()
+                logger.info(f"Model dtype: {dtype}, attention: {attn_implementation}")
+                
+                # Quantized weights are produced by the regular loader; otherwise
+                # load straight from the mmap'd checkpoint shards, falling back
+                # to the regular loader
+                quantization_config = self._quantization_config(dtype)
+                # Gemma 3n is built into transformers, so no remote modeling
+                # code is needed, and safetensors shards avoid the pickle loader
+                use_safetensors = True if self._safetensors_shards() else None
+                if quantization_config is not None:
+                    self.model = AutoModelForCausalLM.from_pretrained(
+                        self.model_path,
+                        torch_dtype=dtype,
+                        attn_implementation=attn_implementation,
+                        quantization_config=quantization_config,
+                        device_map="auto",
+                        use_safetensors=use_safetensors
+                    )
+                else:
+                    try:
+                        self.model = self._load_weights_mmap(config, dtype, attn_implementation)
+                    except Exception as e:
+                        logger.warning(f"⚠️ mmap weight loading failed, using from_pretrained: {e}")
+                        self.model = AutoModelForCausalLM.from_pretrained(
+                            self.model_path,
+                            torch_dtype=dtype,
+                            attn_implementation=attn_implementation,
+                            device_map="auto",
+                            use_safetensors=use_safetensors
+                        )
+                
+                # Fixed-size vision inputs let cuDNN pick its fastest kernels once
+                if torch.cuda.is_available():
+                    torch.backends.cudnn.benchmark = True
+                
+                self.model.eval()
+                self._compile_model()
                 
                 logger.info("✅ Kaggle Gemma model loaded successfully")
                 self.model_loaded = True
                 self.loading = False
                 
+                self._warmup()
+                self._load_draft_model()
+                
             except Exception as e:
                 logger.error(f"❌ Failed to load model: {e}")
                 logger.error(f"Error type: {type(e).__name__}")
@@ -86,17 +213,199 @@ class KaggleGemmaModel:
         
         Thread(target=load, daemon=True).start()
     
+    def _select_dtype(self, config):
+        """Checkpoint's native dtype, or bf16 on Ampere+ GPUs if it would be fp32"""
+        dtype = getattr(config, "torch_dtype", None)
+        if dtype is None and hasattr(config, "text_config"):
+            dtype = getattr(config.text_config, "torch_dtype", None)
+        if isinstance(dtype, str):
+            dtype = getattr(torch, dtype, None)
+        
+        if dtype in (None, torch.float32):
+            if torch.cuda.is_available() and torch.cuda.get_device_capability()[0] >= 8:
+                return torch.bfloat16
+            return "auto"
+        return dtype
+    
+    def _compile_model(self):
+        """torch.compile the forward pass so each decode step replays a CUDA graph"""
+        if not TORCH_COMPILE or not torch.cuda.is_available():
+            return
+        
+        try:
+            self.model.forward = torch.compile(
+                self.model.forward,
+                mode="reduce-overhead",
+                fullgraph=False,
+                dynamic=False
+            )
+            # CUDA graphs need fixed tensor addresses, i.e. a static KV cache
+            self.use_static_cache = True
+            logger.info("⚡ torch.compile enabled (reduce-overhead, static KV cache)")
+        except Exception as e:
+            logger.warning(f"⚠️ torch.compile unavailable, running eager: {e}")
+    
+    def _cache_kwargs(self):
+        """generate() kwargs selecting the KV cache the compiled forward expects"""
+        if self.use_static_cache:
+            return {"cache_implementation": "static"}
+        return {}
+    
+    def _warmup(self):
+        """Run a dummy generate and vision forward so the first request skips kernel autotuning"""
+        if not torch.cuda.is_available():
+            return
+        
+        try:
+            logger.info("🔥 Warming up model...")
+            torch.set_float32_matmul_precision("high")
+            
+            with torch.inference_mode():
+                dummy_ids = torch.zeros((1, 16), dtype=torch.long, device=self.model.device)
+                # With torch.compile the first call compiles and the second
+                # replays the captured CUDA graph
+                for _ in range(2 if self.use_static_cache else 1):
+                    self.model.generate(
+                        dummy_ids,
+                        attention_mask=torch.ones_like(dummy_ids),
+                        max_new_tokens=8,
+                        do_sample=False,
+                        pad_token_id=self.tokenizer.eos_token_id,
+                        **self._cache_kwargs()
+                    )
+                
+                if hasattr(self.model, "get_image_features"):
+                    h, w = VISION_INPUT_SIZE
+                    pixel_values = torch.zeros((1, 3, h, w), dtype=self.model.dtype, device=self.model.device)
+                    self.model.get_image_features(pixel_values)
+            
+            logger.info("✅ Model warmed up")
+        except Exception as e:
+            logger.warning(f"⚠️ Warmup failed: {e}")
+    
+    def _load_draft_model(self):
+        """Load the speculative decoding draft model (optional)"""
+        if not DRAFT_MODEL_PATH:
+            return
+        
+        try:
+            self.draft_tokenizer = AutoTokenizer.from_pretrained(DRAFT_MODEL_PATH, use_fast=True)
+            self.draft_model = AutoModelForCausalLM.from_pretrained(
+                DRAFT_MODEL_PATH,
+                torch_dtype=self.model.dtype
+            ).to(self.model.device).eval()
+            logger.info(f"✅ Draft model loaded for speculative decoding: {DRAFT_MODEL_PATH}")
+        except Exception as e:
+            logger.warning(f"⚠️ Draft model unavailable, decoding without it: {e}")
+            self.draft_model = None
+            self.draft_tokenizer = None
+    
+    def _assistant_kwargs(self):
+        """generate() kwargs for speculative decoding with the draft model.
+        Text-only prompts only: the draft cannot take image soft tokens."""
+        # Assisted generation manages its own dynamic cache
+        return {
+            "assistant_model": self.draft_model,
+            "num_assistant_tokens": NUM_ASSISTANT_TOKENS,
+            "tokenizer": self.tokenizer,
+            "assistant_tokenizer": self.draft_tokenizer
+        }
+    
+    def _quantization_config(self, dtype):
+        """Weight-only quantization config, or None to keep full-precision weights"""
+        if GEMMA_QUANTIZATION not in ("int8", "nf4") or not torch.cuda.is_available():
+            return None
+        
+        try:
+            from transformers import BitsAndBytesConfig
+            import bitsandbytes  # noqa: F401
+        except ImportError:
+            logger.warning("⚠️ bitsandbytes not installed, loading unquantized weights")
+            return None
+        
+        # The vision tower is compute-bound on small tensors, so it stays unquantized
+        skip_modules = ["vision_tower", "multi_modal_projector", "embed_vision", "lm_head"]
+        logger.info(f"📦 Loading weights quantized to {GEMMA_QUANTIZATION}")
+        if GEMMA_QUANTIZATION == "int8":
+            return BitsAndBytesConfig(load_in_8bit=True, llm_int8_skip_modules=skip_modules)
+        return BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_use_double_quant=True,
+            bnb_4bit_compute_dtype=dtype if isinstance(dtype, torch.dtype) else torch.bfloat16,
+            llm_int8_skip_modules=skip_modules
+        )
+    
+    def _attn_implementation(self):
+        """FlashAttention-2 when installed on a GPU box, PyTorch SDPA otherwise"""
+        if torch.cuda.is_available() and importlib.util.find_spec("flash_attn") is not None:
+            return "flash_attention_2"
+        return "sdpa"
+    
+    def _safetensors_shards(self):
+        """Sorted safetensors shard paths under the model directory"""
+        return sorted(glob.glob(os.path.join(self.model_path, "*.safetensors")))
+    
+    def _load_weights_mmap(self, config, dtype, attn_implementation="sdpa"):
+        """Build the model on the meta device and assign checkpoint tensors into it"""
+        from accelerate import init_empty_weights
+        from safetensors.torch import load_file
+        
+        device = "cuda:0" if torch.cuda.is_available() else "cpu"
+        
+        # Parameters are created without storage; buffers stay real because
+        # non-persistent ones (e.g. rotary inv_freq) are not in the checkpoint
+        with init_empty_weights(include_buffers=False):
+            model = AutoModelForCausalLM.from_config(
+                config,
+                torch_dtype=dtype if isinstance(dtype, torch.dtype) else None,
+                attn_implementation=attn_implementation
+            )
+        
+        # Each shard is mmap'd and its tensors assigned in place of the meta
+        # parameters, so the weights are never copied through a CPU model
+        shards = self._safetensors_shards()
+        if shards:
+            for shard in shards:
+                self._assign_weights(model, load_file(shard, device=device), dtype)
+        else:
+            for checkpoint in sorted(glob.glob(os.path.join(self.model_path, "pytorch_model*.bin"))):
+                state_dict = torch.load(checkpoint, mmap=True, weights_only=True, map_location="cpu")
+                self._assign_weights(model, state_dict, dtype)
+        
+        model.tie_weights()
+        missing = [name for name, param in model.named_parameters() if param.device.type == "meta"]
+        if missing:
+            raise RuntimeError(f"{len(missing)} parameters not found in checkpoint (e.g. {missing[0]})")
+        
+        # Only checkpoint tensors take the model dtype; buffers computed at
+        # init (rotary inv_freq) keep their float32, as with from_pretrained
+        model.to(device)
+        return model.eval()
+    
+    @staticmethod
+    def _assign_weights(model, state_dict, dtype):
+        """Assign checkpoint tensors into the model, cast to dtype (assign=True
+        keeps the checkpoint's own dtype otherwise)"""
+        if isinstance(dtype, torch.dtype):
+            state_dict = {
+                name: tensor.to(dtype) if tensor.is_floating_point() else tensor
+                for name, tensor in state_dict.items()
+            }
+        model.load_state_dict(state_dict, assign=True, strict=False)
+    
     def _decode_image(self, image_data):
         """Decode base64 image data"""
         try:
-            if isinstance(image_data, str):
-                if image_data.startswith('data:image'):
-                    image_data = image_data.split(',')[1]
-                image_bytes = base64.b64decode(image_data)
-                return Image.open(BytesIO(image_bytes)).convert('RGB')
+            if self.decode_pool is not None:
+                return self.decode_pool.submit(decode_image_bytes, image_data).result()
+            return decode_image_bytes(image_data)
+        except (binascii.Error, UnidentifiedImageError) as e:
+            # Bad client input (broken base64, not an image) needs no stack
+            logger.warning(f"Image decode error: {type(e).__name__}")
             return None
         except Exception as e:
-            logger.error(f"Image decode error: {e}")
+            _log_exc_rate_limited("Image decode error", e)
             return None
     
     def process_ocr(self, image_data, language='en'):
@@ -140,11 +449,111 @@ This is a mock OCR response. The actual vision model needs proper configuration.
             }
             
         except Exception as e:
-            logger.error(f"OCR error: {e}")
-            import traceback
-            logger.error(traceback.format_exc())
+            _log_exc_rate_limited("OCR error", e)
             return {"error": str(e)}
     
+    def process_ocr_batch(self, image_list, language='en'):
+        """OCR several images with one processor call and one generate()"""
+        try:
+            start_time = time.time()
+            
+            if self.decode_pool is not None:
+                images = list(self.decode_pool.map(decode_image_bytes, image_list))
+            else:
+                images = [decode_image_bytes(image_data) for image_data in image_list]
+            if any(image is None for image in images):
+                return {"error": "Invalid image data"}
+            
+            if not self.model_loaded or self.processor is self.tokenizer:
+                return {"error": "Vision model not loaded"}
+            
+            # Padding every page to a common size lets the vision encoder
+            # run the whole batch as one stacked tensor
+            size = tuple(max(dims) for dims in zip(*(image.size for image in images)))
+            images = [ImageOps.pad(image, size) for image in images]
+            
+            prompt = f"Extract and transcribe all text from this image. Language: {language}"
+            messages = [{"role": "user", "content": [{"type": "image"}, {"type": "text", "text": prompt}]}]
+            text = self.processor.apply_chat_template(messages, add_generation_prompt=True, tokenize=False)
+            
+            # Left padding, set per call as the tokenizer is shared
+            inputs = self.processor(
+                text=[text] * len(images),
+                images=[[image] for image in images],
+                return_tensors="pt",
+                padding=True,
+                padding_side="left"
+            )
+            inputs = self._upload_inputs(inputs)
+            
+            with torch.inference_mode():
+                outputs = self.model.generate(
+                    **inputs,
+                    max_new_tokens=256,
+                    use_cache=True,
+                    do_sample=False,
+                    **self._cache_kwargs()
+                )
+            
+            prompt_length = inputs["input_ids"].shape[-1]
+            texts = [
+                self.processor.decode(row[prompt_length:], skip_special_tokens=True).strip()
+                for row in outputs
+            ]
+            
+            processing_time = time.time() - start_time
+            
+            return {
+                "results": [
+                    {
+                        "text": text,
+                        "extracted_text": text,
+                        "language": language,
+                        "language_detected": language,
+                        "character_count": len(text),
+                        "word_count": len(text.split())
+                    }
+                    for text in texts
+                ],
+                "language": language,
+                "processing_time": processing_time
+            }
+            
+        except Exception as e:
+            logger.error(f"Batch OCR error: {e}")
+            return {"error": str(e)}
+    
+    def _upload_inputs(self, inputs):
+        """Move processor outputs to the GPU, staging pixel_values through pinned memory"""
+        pixel_values = inputs.get("pixel_values")
+        if pixel_values is None or not torch.cuda.is_available():
+            return inputs.to(self.model.device, dtype=self.model.dtype)
+        
+        n = pixel_values.shape[0]
+        if (self.img_buf is None or self.img_buf.shape[0] < n
+                or self.img_buf.shape[1:] != pixel_values.shape[1:]):
+            self.img_buf = torch.empty(
+                (max(MAX_BATCH, n), *pixel_values.shape[1:]),
+                dtype=self.model.dtype,
+                pin_memory=True
+            )
+            self.copy_stream = torch.cuda.Stream()
+        
+        # Pinned source lets the H2D copy run as async DMA on the side stream
+        staged = self.img_buf[:n]
+        staged.copy_(pixel_values)
+        with torch.cuda.stream(self.copy_stream):
+            pixel_values = staged.to(self.model.device, non_blocking=True)
+        
+        inputs = {
+            key: value.to(self.model.device) if torch.is_tensor(value) else value
+            for key, value in inputs.items() if key != "pixel_values"
+        }
+        # The vision tower runs on the default stream, so wait for the copy only there
+        torch.cuda.current_stream().wait_stream(self.copy_stream)
+        inputs["pixel_values"] = pixel_values
+        return inputs
+    
     def process_document_analysis(self, image_data, document_type='general'):
         """Process document analysis request"""
         try:
@@ -177,40 +586,56 @@ This is a mock OCR response. The actual vision model needs proper configuration.
             logger.error(f"Document analysis error: {e}")
             return {"error": str(e)}
     
-    def process_chat(self, messages):
-        """Process regular chat without images"""
+    def process_chat(self, messages, session_id=None):
+        """Process regular chat without images (reusing the session's KV cache if given)"""
         if not self.model_loaded:
             return {"response": "Model is still loading, please wait...", "processing_time": 0}
         
         try:
             start_time = time.time()
             
-            # Format as chat
-            text = ""
-            for msg in messages:
-                role = msg.get("role", "user")
-                content = msg.get("content", "")
-                text += f"{role}: {content}\n"
-            text += "assistant: "
+            # Format and tokenize in one pass with the model's own chat template
+            inputs = self.tokenizer.apply_chat_template(
+                self._chat_messages(messages),
+                add_generation_prompt=True,
+                tokenize=True,
+                return_dict=True,
+                return_tensors="pt"
+            ).to(self.model.device)
             
-            # Generate response
-            inputs = self.tokenizer(text, return_tensors="pt")
+            # Earlier turns of a session are already in its cache, so only the
+            # new messages are prefilled. The compiled forward needs the static
+            # cache, so sessions are stateless when torch.compile is active
+            cache_kwargs = self._cache_kwargs()
+            use_session = session_id is not None and not self.use_static_cache
+            if use_session:
+                cache = self._session_cache(session_id, inputs["input_ids"])
+                cache_kwargs = {"past_key_values": cache}
+            elif self.draft_model is not None and not self.use_static_cache:
+                # The draft proposes NUM_ASSISTANT_TOKENS tokens per step and the
+                # main model verifies them in one forward; it needs a dynamic cache
+                cache_kwargs = self._assistant_kwargs()
             
-            with torch.no_grad():
+            with torch.inference_mode():
                 outputs = self.model.generate(
                     **inputs,
                     max_new_tokens=256,
+                    use_cache=True,
                     do_sample=True,
                     temperature=0.7,
                     top_p=0.9,
-                    pad_token_id=self.tokenizer.eos_token_id
+                    pad_token_id=self.tokenizer.eos_token_id,
+                    **cache_kwargs
                 )
             
-            response = self.tokenizer.decode(outputs[0], skip_special_tokens=True)
+            if use_session:
+                self.sessions[session_id] = (outputs, cache)
+                while len(self.sessions) > MAX_SESSIONS:
+                    self.sessions.popitem(last=False)
             
-            # Extract just the assistant's response
-            if "assistant: " in response:
-                response = response.split("assistant: ")[-1].strip()
+            # Decode only the generated tokens, not the echoed prompt
+            gen_tokens = outputs[0, inputs["input_ids"].shape[-1]:]
+            response = self.tokenizer.decode(gen_tokens, skip_special_tokens=True).strip()
             
             processing_time = time.time() - start_time
             
@@ -222,6 +647,80 @@ This is a mock OCR response. The actual vision model needs proper configuration.
         except Exception as e:
             logger.error(f"Chat error: {e}")
             return {"response": f"Error: {str(e)}", "processing_time": 0}
+    
+    def _session_cache(self, session_id, input_ids):
+        """Session's DynamicCache, cropped to the tokens it shares with input_ids"""
+        entry = self.sessions.pop(session_id, None)
+        if entry is None:
+            return DynamicCache()
+        
+        cached_ids, cache = entry
+        # At least one prompt token has to be left to prefill
+        n = min(cache.get_seq_length(), input_ids.shape[-1] - 1)
+        mismatch = (cached_ids[0, :n] != input_ids[0, :n]).nonzero()
+        shared = mismatch[0].item() if len(mismatch) else n
+        if shared == 0:
+            return DynamicCache()
+        
+        cache.crop(shared)
+        return cache
+    
+    def process_chat_batch(self, conversations):
+        """Process several chats with one padded generate() call"""
+        if not self.model_loaded:
+            return [{"response": "Model is still loading, please wait...", "processing_time": 0}
+                    for _ in conversations]
+        
+        try:
+            start_time = time.time()
+            
+            prompts = [
+                self.tokenizer.apply_chat_template(
+                    self._chat_messages(messages), add_generation_prompt=True, tokenize=False
+                )
+                for messages in conversations
+            ]
+            
+            # Left padding keeps every prompt flush against its generated tokens
+            # (set per call, the tokenizer is shared); the template already
+            # includes the special tokens
+            inputs = self.tokenizer(
+                prompts, return_tensors="pt", padding=True, padding_side="left", add_special_tokens=False
+            ).to(self.model.device)
+            
+            with torch.inference_mode():
+                outputs = self.model.generate(
+                    **inputs,
+                    max_new_tokens=256,
+                    use_cache=True,
+                    do_sample=True,
+                    temperature=0.7,
+                    top_p=0.9,
+                    pad_token_id=self.tokenizer.pad_token_id or self.tokenizer.eos_token_id,
+                    **self._cache_kwargs()
+                )
+            
+            prompt_length = inputs["input_ids"].shape[-1]
+            processing_time = time.time() - start_time
+            
+            return [
+                {
+                    "response": self.tokenizer.decode(row[prompt_length:], skip_special_tokens=True).strip(),
+                    "processing_time": processing_time
+                }
+                for row in outputs
+            ]
+            
+        except Exception as e:
+            logger.error(f"Batch chat error: {e}")
+            return [{"response": f"Error: {str(e)}", "processing_time": 0} for _ in conversations]
+    
+    def _chat_messages(self, messages):
+        """Normalize request messages into chat template input"""
+        return [
+            {"role": msg.get("role", "user"), "content": msg.get("content", "")}
+            for msg in messages
+        ]
 
 class RefugeeConnectServer:
     """Main server class"""
@@ -229,15 +728,113 @@ class RefugeeConnectServer:
     def __init__(self):
         self.app = Flask(__name__)
         CORS(self.app)
+        # request.get_json() and jsonify() both go through the app's provider,
+        # so the multi-MB base64 bodies are parsed by orjson
+        if orjson is not None:
+            self.app.json = OrjsonProvider(self.app)
         
         # Initialize model
         self.model = KaggleGemmaModel()
         
+        # base64 + PIL decoding holds the GIL, so it runs in worker processes
+        self.decode_pool = start_decode_pool(max(1, (os.cpu_count() or 2) // 2))
+        self.model.decode_pool = self.decode_pool
+        
+        # Chat requests are handed to a single consumer on a background event
+        # loop instead of each Flask thread calling generate() itself
+        self._start_model_worker()
+        
         # Setup routes
         self._setup_routes()
         
         logger.info("🚀 Refugee Connect Server initialized")
     
+    def _start_model_worker(self):
+        """Start the asyncio loop thread that owns the model queue"""
+        self.loop = asyncio.new_event_loop()
+        ready = Event()
+        
+        def run():
+            asyncio.set_event_loop(self.loop)
+            self.model_queue = asyncio.Queue()
+            self.loop.create_task(self.server_loop(self.model_queue))
+            ready.set()
+            self.loop.run_forever()
+        
+        Thread(target=run, daemon=True).start()
+        ready.wait()
+    
+    async def server_loop(self, q):
+        """Single consumer, so the GPU only ever sees one generate() at a time"""
+        while True:
+            try:
+                await self._serve_batch(q)
+            except Exception as e:
+                # The consumer must outlive any one batch; its callers time out
+                logger.error(f"Model queue error: {e}")
+    
+    async def _serve_batch(self, q):
+        """Take the next job (plus any queued chats to batch with it) and run it"""
+        batch = [await q.get()]
+        
+        # Batching only pays off under load, so a lone request is not held back
+        if not q.empty():
+            while len(batch) < MAX_BATCH:
+                try:
+                    batch.append(await asyncio.wait_for(q.get(), timeout=BATCH_TIMEOUT))
+                except asyncio.TimeoutError:
+                    break
+        
+        # Chats in the batch share one generate(); other jobs run in order
+        chats = [(payload, response_q) for kind, payload, response_q in batch if kind == "chat"]
+        if chats:
+            await self._run_chat_batch(chats)
+        
+        for kind, payload, response_q in batch:
+            if kind == "session_chat":
+                messages, session_id = payload
+                try:
+                    result = await self.loop.run_in_executor(None, self.model.process_chat, messages, session_id)
+                except Exception as e:
+                    result = {"response": f"Error: {str(e)}", "processing_time": 0}
+                await response_q.put(result)
+            elif kind == "ocr_batch":
+                images, language = payload
+                try:
+                    result = await self.loop.run_in_executor(None, self.model.process_ocr_batch, images, language)
+                except Exception as e:
+                    result = {"error": str(e)}
+                await response_q.put(result)
+    
+    async def _run_chat_batch(self, chats):
+        """Generate replies for queued chats and hand each back to its caller"""
+        conversations = [messages for messages, _ in chats]
+        try:
+            if len(chats) == 1:
+                results = [await self.loop.run_in_executor(None, self.model.process_chat, conversations[0])]
+            else:
+                results = await self.loop.run_in_executor(None, self.model.process_chat_batch, conversations)
+        except Exception as e:
+            results = [{"response": f"Error: {str(e)}", "processing_time": 0} for _ in chats]
+        
+        for (_, response_q), result in zip(chats, results):
+            await response_q.put(result)
+    
+    async def _submit(self, kind, payload):
+        """Queue a model job ('chat', 'session_chat' or 'ocr_batch') and wait for its result"""
+        response_q = asyncio.Queue()
+        await self.model_queue.put((kind, payload, response_q))
+        return await response_q.get()
+    
+    def _wait(self, job):
+        """Run a _submit job from a route thread, waiting at most JOB_TIMEOUT seconds"""
+        future = asyncio.run_coroutine_threadsafe(job, self.loop)
+        try:
+            return future.result(timeout=JOB_TIMEOUT)
+        except FutureTimeoutError:
+            future.cancel()
+            raise
+    
     def _setup_routes(self):
         """Setup all API routes"""
         
@@ -276,6 +873,30 @@ class RefugeeConnectServer:
                 logger.error(f"OCR endpoint error: {e}")
                 return jsonify({"error": str(e)}), 500
         
+        @self.app.route('/api/vision/ocr_batch', methods=['POST'])
+        def vision_ocr_batch():
+            try:
+                data = request.get_json()
+                images = data.get('images')
+                if not images or not isinstance(images, list):
+                    return jsonify({"error": "No image data provided"}), 400
+                
+                result = self._wait(self._submit("ocr_batch", (images, data.get('language', 'en'))))
+                
+                if 'error' in result:
+                    return jsonify(result), 500
+                
+                return jsonify({
+                    "success": True,
+                    **result
+                })
+                
+            except FutureTimeoutError:
+                return jsonify({"error": "Request timed out - server busy"}), 504
+            except Exception as e:
+                logger.error(f"Batch OCR endpoint error: {e}")
+                return jsonify({"error": str(e)}), 500
+        
         @self.app.route('/api/vision/document', methods=['POST'])
         def document_analysis():
             try:
@@ -305,13 +926,22 @@ class RefugeeConnectServer:
             try:
                 data = request.get_json()
                 
-                # For now, treat as text-only chat
-                messages = [{
+                # For now, treat as text-only chat; clients may send the whole
+                # conversation as 'messages'
+                messages = data.get('messages') or [{
                     "role": "user",
                     "content": data.get('text', '')
                 }]
                 
-                result = self.model.process_chat(messages)
+                # Chats with a session_id reuse that session's KV cache, so they
+                # are not batched with other requests
+                session_id = data.get('session_id')
+                if session_id:
+                    job = self._submit("session_chat", (messages, session_id))
+                else:
+                    job = self._submit("chat", messages)
+                
+                result = self._wait(job)
                 
                 return jsonify({
                     "success": True,
@@ -322,6 +952,8 @@ class RefugeeConnectServer:
                     "confidence": 0.9
                 })
                 
+            except FutureTimeoutError:
+                return jsonify({"error": "Request timed out - server busy"}), 504
             except Exception as e:
                 logger.error(f"Chat error: {e}")
                 return jsonify({"error": str(e)}), 500
@@ -6,19 +6,45 @@ Adds priority-based processing and better concurrent request handling
 
 import os
 import sys
+import gc
 import json
 import time
+import base64
+import binascii
 import asyncio
+import functools
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from threading import Thread
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import pybase64
+except ImportError:
+    pybase64 = None
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 # Add enhanced modules to path
 sys.path.append(os.path.join(os.path.dirname(__file__), 'enhanced'))
 
 # Import the original server and queue
-from ai_server_multimodal import MemorySafetyGuard, MockMultimodalModel, ProductionMultimodalModel
-from request_queue import AdvancedRequestQueue, Priority, QueuedRequest
+from ai_server_multimodal import (
+    MemorySafetyGuard, MockMultimodalModel, ProductionMultimodalModel, VisionBatcher,
+    OrjsonProvider, Preempted, _parse_json
+)
+from request_queue import AdvancedRequestQueue, Priority, QueuedRequest, Requeued
+from server_config import ConfigManager
 
 import logging
 
@@ -29,12 +55,115 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Work at these priorities can be interrupted by an EMERGENCY request and re-queued
+PREEMPTIBLE = (Priority.NORMAL, Priority.LOW)
+
+# How long (seconds) a dispatched request waits for others of its type to batch with
+BATCH_WAIT = 0.002
+
+# Allocations between young-generation collections (the default is 700)
+GC_THRESHOLD = (50000, 100, 100)
+
+# Development only: call the mock model straight from the route thread,
+# bypassing the queue (and with it priorities, preemption and timeouts)
+DEV_DIRECT_CALLS = os.getenv('DEV_DIRECT_CALLS', '0') == '1'
+
+# /api/status polls reuse a queue snapshot at most this old (seconds)
+STATUS_TTL = 0.2
+
+# Comma-separated origins allowed to call the API, and how long (seconds)
+# browsers may cache a preflight answer
+CORS_ORIGINS = os.getenv('CORS_ORIGINS', '*').split(',')
+CORS_MAX_AGE = 600
+
+# GemPath prompt templates, split around their per-request parts
+GEMPATH_ANALYZE_PRE = """
+        Analyze this family reunification form data and extract key information:
+        
+        Form Data: """
+GEMPATH_ANALYZE_POST = """
+        
+        Please extract and structure:
+        1. Person details (name, age, gender, description)
+        2. Family relationships and members
+        3. Locations (origin, current, seeking)
+        4. Timeline and dates
+        5. Key identifying information
+        6. Contact preferences
+        
+        Return structured JSON with extracted information and confidence scores.
+        """
+
+GEMPATH_SEARCH_PRE = """
+        Search for potential family matches based on this information:
+        
+        Search Query: """
+GEMPATH_SEARCH_MID = """
+        Person Data: """
+GEMPATH_SEARCH_POST = """
+        
+        Based on the provided information, suggest potential matching strategies and
+        generate search parameters that could help find family members:
+        
+        1. Key identifiers to search for
+        2. Location-based search strategies  
+        3. Timeline correlation methods
+        4. Physical description matching
+        5. Cultural/linguistic connections
+        
+        Return a structured response with search recommendations and confidence levels.
+        """
+
+GEMPATH_VERIFY_PRE = """
+        Verify if these two family records could be a match:
+        
+        Person A: """
+GEMPATH_VERIFY_MID = """
+        Person B: """
+GEMPATH_VERIFY_POST = """
+        
+        Analyze and compare:
+        1. Name similarities and variations
+        2. Age consistency and timelines
+        3. Location correlations
+        4. Physical descriptions
+        5. Family relationship patterns
+        6. Cultural and linguistic indicators
+        
+        Provide a verification assessment with:
+        - Confidence score (0-100)
+        - Matching factors
+        - Conflicting information
+        - Recommendations for further verification
+        
+        Return structured JSON with detailed analysis.
+        """
+
+def _decode_image_field(data: dict):
+    """Decode a base64 'image' field to bytes in place, once, before it is queued"""
+    image = data.get('image')
+    if isinstance(image, str) and image:
+        if image.startswith('data:image'):
+            image = image.partition(',')[2]
+        data['image'] = (pybase64 or base64).b64decode(image, validate=False)
+
+def _dumps(obj) -> str:
+    """Compact JSON for embedding form data in a prompt"""
+    if orjson is not None:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':'))
+
 class EnhancedMultimodalAIServer:
     """Enhanced AI server with request queuing and priority processing"""
     
     def __init__(self):
         self.app = Flask(__name__)
-        CORS(self.app)
+        CORS(self.app, origins=CORS_ORIGINS, max_age=CORS_MAX_AGE)
+        # jsonify() and request parsing go through orjson when it is installed
+        if orjson is not None:
+            self.app.json = OrjsonProvider(self.app)
+        else:
+            self.app.json.sort_keys = False
         
         # Initialize base components
         self.is_development = MemorySafetyGuard.ensure_development_safety()
@@ -44,29 +173,89 @@ class EnhancedMultimodalAIServer:
         else:
             self.model = ProductionMultimodalModel()
         
+        # Deployment config (REFUGEE_CONNECT_ENV, else the detected mode)
+        self.config = ConfigManager.get_config(
+            os.getenv('REFUGEE_CONNECT_ENV') or ('development' if self.is_development else 'production')
+        )
+        queue_config = self.config.queue
+        
         # Initialize request queue
         self.request_queue = AdvancedRequestQueue(
             max_size=30,  # Larger queue for production
             max_concurrent=4 if self.is_development else 3,  # Fewer concurrent for real model
-            overflow_policy='drop_lowest_priority'
+            overflow_policy='drop_lowest_priority',
+            request_timeout=queue_config.request_timeout
         )
+        # Routes allow queue_timeout for the wait in the queue on top of the
+        # model call's request_timeout, so a call that runs too long is stopped
+        # and answered by the queue rather than abandoned by its route
+        self.route_timeout = queue_config.queue_timeout + queue_config.request_timeout
         
         # Stats tracking
         self.stats = {
             "mode": "DEVELOPMENT" if self.is_development else "PRODUCTION",
-            "start_time": time.time(),
             "total_requests": 0,
             "vision_requests": 0,
-            "processing_times": [],
+            "processing_times": deque(maxlen=100),  # Last 100 requests
             "queue_stats": {}
         }
+        # Uptime and queue times use the monotonic clock, immune to NTP steps
+        self._start_ns = time.monotonic_ns()
+        
+        # Static part of /api/status, and the latest (taken at, queue status)
+        self._capabilities = {
+            "vision": True,
+            "multimodal": True,
+            "languages": ["en", "ar", "fa", "ur", "ps"],
+            "max_concurrent": self.request_queue.max_concurrent,
+            "queue_size": self.request_queue.max_size
+        }
+        self._last_queue_status = (0.0, None)
+        # Running sum of processing_times, so the average needs no pass over it;
+        # updated from route threads too in development
+        self._processing_time_sum = 0.0
+        self._stats_lock = threading.Lock()
+        
+        # GemPath prompts start with fixed instructions; models that support it
+        # prefill those once and reuse the KV cache for every request whose
+        # prompt starts with them. This only applies with torch.compile off:
+        # under the compiled forward's static cache register_prefix is a no-op
+        if hasattr(self.model, 'register_prefix'):
+            for prefix in (GEMPATH_ANALYZE_PRE, GEMPATH_SEARCH_PRE, GEMPATH_VERIFY_PRE):
+                self.model.register_prefix(prefix)
+        
+        # One model thread per queue slot, so the queue's concurrency limit is
+        # the real one. Every model call gets an abort event: the queue's
+        # timeout sets it, and an arriving EMERGENCY request sets those of the
+        # preemptible calls in _preemptible_calls, to free their threads
+        max_concurrent = self.request_queue.max_concurrent
+        self.model_exec = ThreadPoolExecutor(max_workers=max_concurrent, thread_name_prefix='model')
+        self._preemptible_calls = set()
+        
+        # Requests of the same type dispatched together share one model call
+        # when the model supports batching (production only); urgent and
+        # preemptible requests never share a batch
+        self.batchers = None
+        if hasattr(self.model, 'process_batch'):
+            self.batchers = {
+                preemptible: VisionBatcher(
+                    functools.partial(self._run_batch, preemptible=preemptible),
+                    self.model.batch_key,
+                    max_batch=max_concurrent,
+                    timeout=BATCH_WAIT
+                )
+                for preemptible in (False, True)
+            }
         
-        # Start async event loop in background thread
-        self.loop = asyncio.new_event_loop()
+        # Start async event loop in background thread; every request crosses
+        # it, so use libuv's loop when available
+        self.loop = uvloop.new_event_loop() if uvloop is not None else asyncio.new_event_loop()
+        self.loop.set_default_executor(self.model_exec)
         self.async_thread = Thread(target=self._run_async_loop, daemon=True)
         self.async_thread.start()
         
         # Start request processor
+        self.request_queue.on_error = self._fail_request
         asyncio.run_coroutine_threadsafe(
             self.request_queue.process_requests(self._process_request),
             self.loop
@@ -75,6 +264,13 @@ class EnhancedMultimodalAIServer:
         # Set up routes
         self._setup_routes()
         
+        # Everything allocated so far (model weights, executors, routes) lives as
+        # long as the server; move it out of the collector's scans and make
+        # collections triggered by short-lived request objects rarer
+        gc.collect()
+        gc.freeze()
+        gc.set_threshold(*GC_THRESHOLD)
+        
         logger.info("Enhanced Multimodal AI Server initialized")
     
     def _run_async_loop(self):
@@ -82,6 +278,19 @@ class EnhancedMultimodalAIServer:
         asyncio.set_event_loop(self.loop)
         self.loop.run_forever()
     
+    def _ingest_image(self, data: dict):
+        """Decode the request's image once, in the route thread: base64 to bytes,
+        then to the array the model consumes when it can take one. Returns
+        False when the image data is invalid."""
+        try:
+            _decode_image_field(data)
+            if hasattr(self.model, 'decode_image') and isinstance(data.get('image'), bytes):
+                data['image'] = self.model.decode_image(data['image'])
+        except (binascii.Error, ValueError) as e:
+            logger.warning(f"Image decode error: {type(e).__name__}")
+            return False
+        return True
+    
     def _get_priority_from_request_type(self, request_type: str, data: dict) -> Priority:
         """Determine priority based on request type and content"""
         # Medical requests are always high priority
@@ -115,171 +324,115 @@ class EnhancedMultimodalAIServer:
         return Priority.NORMAL
     
     async def _process_request(self, queued_request: QueuedRequest) -> dict:
-        """Process a queued request"""
+        """Process a queued request and hand the result to the waiting route"""
         request_type = queued_request.request_type
         payload = queued_request.payload
+        response_future = payload.pop('_response_future', None)
+        
+        priority = queued_request.priority
+        
+        # The route already gave up waiting
+        if response_future is not None and response_future.cancelled():
+            return {"error": "Request timed out before processing"}
         
         try:
-            if request_type == 'ocr':
-                return await self._process_ocr_async(payload)
-            elif request_type == 'document':
-                return await self._process_document_async(payload)
-            elif request_type == 'medical':
-                return await self._process_medical_async(payload)
-            elif request_type == 'chat':
-                return await self._process_chat_async(payload)
-            elif request_type == 'gempath_analyze':
-                return await self._process_gempath_analyze_async(payload)
-            elif request_type == 'gempath_search':
-                return await self._process_gempath_search_async(payload)
-            elif request_type == 'gempath_verify':
-                return await self._process_gempath_verify_async(payload)
-            else:
-                raise ValueError(f"Unknown request type: {request_type}")
+            method, args = self._model_call(request_type, payload)
+            result = await self._call_model(method, *args, priority=priority)
+        
+        except asyncio.CancelledError:
+            # The queue's request timeout; the model call has stopped by now
+            if response_future is not None and not response_future.done():
+                response_future.set_result({"error": "Request timed out - server overloaded"})
+            raise
+        
+        except Preempted:
+            # Back in the queue behind the emergency, still answering the same route
+            logger.info(f"Request {queued_request.id} preempted, re-queued")
+            payload['_response_future'] = response_future
+            await self._enqueue(request_type, payload, priority, requeued=True)
+            raise Requeued()
                 
         except Exception as e:
             logger.error(f"Error processing request {queued_request.id}: {e}")
-            return {"error": str(e)}
-    
-    async def _process_ocr_async(self, data: dict) -> dict:
-        """Async OCR processing"""
-        # Run in executor to avoid blocking
-        loop = asyncio.get_event_loop()
-        return await loop.run_in_executor(
-            None,
-            self.model.process_ocr,
-            data['image'],
-            data.get('language', 'en')
-        )
-    
-    async def _process_document_async(self, data: dict) -> dict:
-        """Async document processing"""
-        loop = asyncio.get_event_loop()
-        return await loop.run_in_executor(
-            None,
-            self.model.process_document_analysis,
-            data['image'],
-            data.get('document_type', 'general')
-        )
+            result = {"error": str(e)}
+        
+        if 'processing_time' in result:
+            self._record_processing_time(result['processing_time'])
+        
+        if response_future is not None and not response_future.done():
+            response_future.set_result(result)
+        return result
     
-    async def _process_medical_async(self, data: dict) -> dict:
-        """Async medical image processing"""
-        loop = asyncio.get_event_loop()
-        return await loop.run_in_executor(
-            None,
-            self.model.process_medical_image,
-            data['image'],
-            data.get('symptoms', '')
-        )
+    async def _call_model(self, method: str, *args, priority: Priority = Priority.NORMAL) -> dict:
+        """Run a model method off the event loop, batched with concurrent calls when possible"""
+        preemptible = priority in PREEMPTIBLE
+        if self.batchers is not None:
+            return await self.batchers[preemptible].submit(method, *args)
+        
+        abort_event = threading.Event()
+        call = functools.partial(getattr(self.model, method), *args, abort_event=abort_event)
+        return await self._run_abortable(call, abort_event, preemptible)
     
-    async def _process_chat_async(self, data: dict) -> dict:
-        """Async multimodal chat processing"""
-        loop = asyncio.get_event_loop()
-        return await loop.run_in_executor(
-            None,
-            self.model.process_multimodal_chat,
-            data.get('text', ''),
-            data.get('image')
-        )
+    async def _run_batch(self, method: str, args_list: list, preemptible: bool = False) -> list:
+        """Run one batch of same-type model calls in the executor"""
+        abort_event = threading.Event()
+        call = functools.partial(self.model.process_batch, method, args_list, abort_event=abort_event)
+        return await self._run_abortable(call, abort_event, preemptible)
     
-    async def _process_gempath_analyze_async(self, data: dict) -> dict:
-        """Async family reunification form analysis"""
-        loop = asyncio.get_event_loop()
-        
-        # Create analysis prompt for family data
-        prompt = f"""
-        Analyze this family reunification form data and extract key information:
-        
-        Form Data: {json.dumps(data, indent=2)}
-        
-        Please extract and structure:
-        1. Person details (name, age, gender, description)
-        2. Family relationships and members
-        3. Locations (origin, current, seeking)
-        4. Timeline and dates
-        5. Key identifying information
-        6. Contact preferences
-        
-        Return structured JSON with extracted information and confidence scores.
-        """
-        
-        return await loop.run_in_executor(
-            None,
-            self.model.process_multimodal_chat,
-            prompt,
-            None
-        )
+    async def _run_abortable(self, call, abort_event: threading.Event, preemptible: bool):
+        """Run a model call in the executor. If the awaiting task is cancelled,
+        the call is told to stop and its thread is waited for, so a queue slot
+        is never freed while its model thread is still busy."""
+        future = asyncio.get_running_loop().run_in_executor(self.model_exec, call)
+        if preemptible:
+            self._preemptible_calls.add(abort_event)
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            abort_event.set()
+            await asyncio.wait([future])
+            raise
+        finally:
+            self._preemptible_calls.discard(abort_event)
     
-    async def _process_gempath_search_async(self, data: dict) -> dict:
-        """Async family member search processing"""
-        loop = asyncio.get_event_loop()
-        
-        # Create search prompt
-        search_query = data.get('search_query', '')
-        person_data = data.get('person_data', {})
-        
-        prompt = f"""
-        Search for potential family matches based on this information:
-        
-        Search Query: {search_query}
-        Person Data: {json.dumps(person_data, indent=2)}
-        
-        Based on the provided information, suggest potential matching strategies and
-        generate search parameters that could help find family members:
-        
-        1. Key identifiers to search for
-        2. Location-based search strategies  
-        3. Timeline correlation methods
-        4. Physical description matching
-        5. Cultural/linguistic connections
-        
-        Return a structured response with search recommendations and confidence levels.
-        """
-        
-        return await loop.run_in_executor(
-            None,
-            self.model.process_multimodal_chat,
-            prompt,
-            data.get('image')
-        )
+    def _preempt_running(self):
+        """Interrupt in-flight preemptible work"""
+        if self._preemptible_calls:
+            logger.warning("EMERGENCY request queued - preempting normal/low priority work")
+            for abort_event in self._preemptible_calls:
+                abort_event.set()
     
-    async def _process_gempath_verify_async(self, data: dict) -> dict:
-        """Async family match verification processing"""
-        loop = asyncio.get_event_loop()
-        
-        # Create verification prompt
-        match_data = data.get('match_data', {})
-        person_data = data.get('person_data', {})
-        
-        prompt = f"""
-        Verify if these two family records could be a match:
-        
-        Person A: {json.dumps(person_data, indent=2)}
-        Person B: {json.dumps(match_data, indent=2)}
-        
-        Analyze and compare:
-        1. Name similarities and variations
-        2. Age consistency and timelines
-        3. Location correlations
-        4. Physical descriptions
-        5. Family relationship patterns
-        6. Cultural and linguistic indicators
-        
-        Provide a verification assessment with:
-        - Confidence score (0-100)
-        - Matching factors
-        - Conflicting information
-        - Recommendations for further verification
-        
-        Return structured JSON with detailed analysis.
-        """
-        
-        return await loop.run_in_executor(
-            None,
-            self.model.process_multimodal_chat,
-            prompt,
-            data.get('image')
-        )
+    def _model_call(self, request_type: str, data: dict) -> tuple:
+        """The model method and arguments that serve a request of this type"""
+        if request_type == 'ocr':
+            return 'process_vision_ocr', (data['image'], data.get('language', 'en'))
+        elif request_type == 'document':
+            return 'process_document_analysis', (data['image'], data.get('document_type', 'general'))
+        elif request_type == 'medical':
+            return 'process_medical_image', (data['image'], data.get('symptoms', ''))
+        elif request_type == 'chat':
+            return 'process_multimodal_chat', (data.get('text', ''), data.get('image'))
+        
+        # GemPath family reunification requests are chat prompts built from the form data
+        elif request_type == 'gempath_analyze':
+            prompt = GEMPATH_ANALYZE_PRE + _dumps(data) + GEMPATH_ANALYZE_POST
+            return 'process_multimodal_chat', (prompt, None)
+        elif request_type == 'gempath_search':
+            prompt = "".join((
+                GEMPATH_SEARCH_PRE, str(data.get('search_query', '')),
+                GEMPATH_SEARCH_MID, _dumps(data.get('person_data', {})),
+                GEMPATH_SEARCH_POST
+            ))
+            return 'process_multimodal_chat', (prompt, data.get('image'))
+        elif request_type == 'gempath_verify':
+            prompt = "".join((
+                GEMPATH_VERIFY_PRE, _dumps(data.get('person_data', {})),
+                GEMPATH_VERIFY_MID, _dumps(data.get('match_data', {})),
+                GEMPATH_VERIFY_POST
+            ))
+            return 'process_multimodal_chat', (prompt, data.get('image'))
+        
+        raise ValueError(f"Unknown request type: {request_type}")
     
     def _setup_routes(self):
         """Set up enhanced Flask routes with queuing"""
@@ -287,44 +440,38 @@ class EnhancedMultimodalAIServer:
         @self.app.route('/api/status', methods=['GET'])
         def status():
             """Enhanced status with queue information"""
-            queue_status = self.request_queue.get_queue_status()
+            now = time.monotonic()
+            taken_at, queue_status = self._last_queue_status
+            if now - taken_at > STATUS_TTL:
+                queue_status = self.request_queue.get_queue_status()
+                self._last_queue_status = (now, queue_status)
             
             return jsonify({
                 "status": "online",
                 "mode": self.stats["mode"],
-                "uptime_seconds": int(time.time() - self.stats["start_time"]),
+                "uptime_seconds": (time.monotonic_ns() - self._start_ns) // 1_000_000_000,
                 "total_requests": self.stats["total_requests"],
                 "vision_requests": self.stats["vision_requests"],
                 "avg_processing_time_ms": self._calculate_avg_processing_time(),
                 "queue": queue_status,
-                "capabilities": {
-                    "vision": True,
-                    "multimodal": True,
-                    "languages": ["en", "ar", "fa", "ur", "ps"],
-                    "max_concurrent": self.request_queue.max_concurrent,
-                    "queue_size": self.request_queue.max_size
-                }
+                "capabilities": self._capabilities
             })
         
         @self.app.route('/api/vision/ocr', methods=['POST'])
         def vision_ocr():
             """Enhanced OCR with queuing"""
             try:
-                data = request.get_json()
+                data = _parse_json()
                 if not data.get('image'):
                     return jsonify({"error": "No image data provided"}), 400
+                if not self._ingest_image(data):
+                    return jsonify({"error": "Invalid image data"}), 400
                 
                 # Determine priority
                 priority = self._get_priority_from_request_type('ocr', data)
                 
                 # Queue request
-                future = asyncio.run_coroutine_threadsafe(
-                    self._queue_and_wait('ocr', data, priority),
-                    self.loop
-                )
-                
-                # Wait for result with timeout
-                result = future.result(timeout=60)  # 60 second timeout
+                result = self._submit('ocr', data, priority)
                 
                 if 'error' in result:
                     return jsonify({"error": result['error']}), 500
@@ -334,15 +481,15 @@ class EnhancedMultimodalAIServer:
                 
                 return jsonify({
                     "success": True,
-                    "text": result['text'],
-                    "language": result['language'],
+                    "text": result['extracted_text'],
+                    "language": result['language_detected'],
                     "confidence": result['confidence'],
                     "processing_time_ms": round(result['processing_time'] * 1000),
                     "queue_time_ms": result.get('queue_time_ms', 0),
                     "mode": self.stats["mode"]
                 })
                 
-            except asyncio.TimeoutError:
+            except FutureTimeoutError:
                 return jsonify({"error": "Request timeout - server overloaded"}), 503
             except Exception as e:
                 logger.error(f"OCR error: {e}")
@@ -352,20 +499,17 @@ class EnhancedMultimodalAIServer:
         def document_analysis():
             """Enhanced document analysis with queuing"""
             try:
-                data = request.get_json()
+                data = _parse_json()
                 if not data.get('image'):
                     return jsonify({"error": "No image data provided"}), 400
+                if not self._ingest_image(data):
+                    return jsonify({"error": "Invalid image data"}), 400
                 
                 # Determine priority
                 priority = self._get_priority_from_request_type('document', data)
                 
                 # Queue request
-                future = asyncio.run_coroutine_threadsafe(
-                    self._queue_and_wait('document', data, priority),
-                    self.loop
-                )
-                
-                result = future.result(timeout=60)
+                result = self._submit('document', data, priority)
                 
                 if 'error' in result:
                     return jsonify({"error": result['error']}), 500
@@ -387,7 +531,7 @@ class EnhancedMultimodalAIServer:
                     "mode": self.stats["mode"]
                 })
                 
-            except asyncio.TimeoutError:
+            except FutureTimeoutError:
                 return jsonify({"error": "Request timeout - server overloaded"}), 503
             except Exception as e:
                 logger.error(f"Document analysis error: {e}")
@@ -397,20 +541,17 @@ class EnhancedMultimodalAIServer:
         def medical_image_analysis():
             """Enhanced medical image analysis with priority queuing"""
             try:
-                data = request.get_json()
+                data = _parse_json()
                 if not data.get('image'):
                     return jsonify({"error": "No image data provided"}), 400
+                if not self._ingest_image(data):
+                    return jsonify({"error": "Invalid image data"}), 400
                 
                 # Medical requests get higher priority
                 priority = self._get_priority_from_request_type('medical', data)
                 
                 # Queue request
-                future = asyncio.run_coroutine_threadsafe(
-                    self._queue_and_wait('medical', data, priority),
-                    self.loop
-                )
-                
-                result = future.result(timeout=60)
+                result = self._submit('medical', data, priority)
                 
                 if 'error' in result:
                     return jsonify({"error": result['error']}), 500
@@ -431,7 +572,7 @@ class EnhancedMultimodalAIServer:
                     "mode": self.stats["mode"]
                 })
                 
-            except asyncio.TimeoutError:
+            except FutureTimeoutError:
                 return jsonify({"error": "Request timeout - server overloaded"}), 503
             except Exception as e:
                 logger.error(f"Medical image analysis error: {e}")
@@ -441,26 +582,20 @@ class EnhancedMultimodalAIServer:
         def multimodal_chat():
             """Enhanced multimodal chat with queuing"""
             try:
-                data = request.get_json()
+                data = _parse_json()
                 if not data.get('text') and not data.get('image'):
                     return jsonify({"error": "No text or image provided"}), 400
+                if not self._ingest_image(data):
+                    return jsonify({"error": "Invalid image data"}), 400
                 
                 # Determine priority
                 priority = self._get_priority_from_request_type('chat', data)
                 
-                # Queue request
-                future = asyncio.run_coroutine_threadsafe(
-                    self._queue_and_wait('chat', data, priority),
-                    self.loop
-                )
-                
-                result = future.result(timeout=60)
+                result = self._run_chat(data, priority)
                 
                 if 'error' in result:
                     return jsonify({"error": result['error']}), 500
                 
-                self.stats["total_requests"] += 1
-                
                 return jsonify({
                     "success": True,
                     "response": result['response'],
@@ -472,7 +607,7 @@ class EnhancedMultimodalAIServer:
                     "mode": self.stats["mode"]
                 })
                 
-            except asyncio.TimeoutError:
+            except FutureTimeoutError:
                 return jsonify({"error": "Request timeout - server overloaded"}), 503
             except Exception as e:
                 logger.error(f"Multimodal chat error: {e}")
@@ -482,18 +617,12 @@ class EnhancedMultimodalAIServer:
         @self.app.route('/api/process', methods=['POST'])
         def process_text():
             """Legacy text processing endpoint"""
-            data = request.get_json()
+            data = _parse_json()
             text = data.get('prompt', '')
             
             # Use chat endpoint with normal priority
-            future = asyncio.run_coroutine_threadsafe(
-                self._queue_and_wait('chat', {'text': text}, Priority.NORMAL),
-                self.loop
-            )
-            
             try:
-                result = future.result(timeout=30)
-                self.stats["total_requests"] += 1
+                result = self._run_chat({'text': text}, Priority.NORMAL)
                 return jsonify({
                     "response": result.get('response', 'Processing failed'),
                     "processing_time_ms": round(result.get('processing_time', 0) * 1000)
@@ -506,7 +635,7 @@ class EnhancedMultimodalAIServer:
         def gempath_analyze():
             """Analyze family reunification form data"""
             try:
-                data = request.get_json()
+                data = _parse_json()
                 if not data:
                     return jsonify({"error": "No data provided"}), 400
                 
@@ -514,12 +643,7 @@ class EnhancedMultimodalAIServer:
                 priority = Priority.HIGH
                 
                 # Queue request
-                future = asyncio.run_coroutine_threadsafe(
-                    self._queue_and_wait('gempath_analyze', data, priority),
-                    self.loop
-                )
-                
-                result = future.result(timeout=45)  # 45 second timeout
+                result = self._submit('gempath_analyze', data, priority)
                 
                 if 'error' in result:
                     return jsonify({"error": result['error']}), 500
@@ -535,20 +659,17 @@ class EnhancedMultimodalAIServer:
         def gempath_search():
             """Search for potential family matches"""
             try:
-                data = request.get_json()
+                data = _parse_json()
                 if not data:
                     return jsonify({"error": "No search data provided"}), 400
+                if not self._ingest_image(data):
+                    return jsonify({"error": "Invalid image data"}), 400
                 
                 # High priority for family searches
                 priority = Priority.HIGH
                 
                 # Queue request
-                future = asyncio.run_coroutine_threadsafe(
-                    self._queue_and_wait('gempath_search', data, priority),
-                    self.loop
-                )
-                
-                result = future.result(timeout=60)  # 60 second timeout for searches
+                result = self._submit('gempath_search', data, priority)
                 
                 if 'error' in result:
                     return jsonify({"error": result['error']}), 500
@@ -564,20 +685,17 @@ class EnhancedMultimodalAIServer:
         def gempath_verify():
             """Verify potential family matches"""
             try:
-                data = request.get_json()
+                data = _parse_json()
                 if not data:
                     return jsonify({"error": "No verification data provided"}), 400
+                if not self._ingest_image(data):
+                    return jsonify({"error": "Invalid image data"}), 400
                 
                 # High priority for family verification
                 priority = Priority.HIGH
                 
                 # Queue request
-                future = asyncio.run_coroutine_threadsafe(
-                    self._queue_and_wait('gempath_verify', data, priority),
-                    self.loop
-                )
-                
-                result = future.result(timeout=30)  # 30 second timeout for verification
+                result = self._submit('gempath_verify', data, priority)
                 
                 if 'error' in result:
                     return jsonify({"error": result['error']}), 500
@@ -594,22 +712,14 @@ class EnhancedMultimodalAIServer:
         def translate():
             """Legacy translation endpoint"""
             try:
-                data = request.get_json()
+                data = _parse_json()
                 text = data.get('text', '')
                 from_lang = data.get('from', 'auto')
                 to_lang = data.get('to', 'en')
                 
                 # Convert to chat format
                 prompt = f"Translate this text from {from_lang} to {to_lang}: {text}"
-                chat_data = {'text': prompt}
-                
-                future = asyncio.run_coroutine_threadsafe(
-                    self._queue_and_wait('chat', chat_data, Priority.NORMAL),
-                    self.loop
-                )
-                
-                result = future.result(timeout=30)
-                self.stats["total_requests"] += 1
+                result = self._run_chat({'text': prompt}, Priority.NORMAL)
                 
                 return jsonify({
                     "translated_text": result.get('response', text),
@@ -625,20 +735,12 @@ class EnhancedMultimodalAIServer:
         def medical():
             """Legacy medical endpoint"""
             try:
-                data = request.get_json()
+                data = _parse_json()
                 symptoms = data.get('symptoms', '')
                 
                 # Convert to chat format
                 prompt = f"Provide medical guidance for these symptoms: {symptoms}. Include triage recommendations and when to seek immediate care."
-                chat_data = {'text': prompt}
-                
-                future = asyncio.run_coroutine_threadsafe(
-                    self._queue_and_wait('chat', chat_data, Priority.HIGH),
-                    self.loop
-                )
-                
-                result = future.result(timeout=30)
-                self.stats["total_requests"] += 1
+                result = self._run_chat({'text': prompt}, Priority.HIGH)
                 
                 return jsonify({
                     "medical_advice": result.get('response', 'Unable to provide medical guidance'),
@@ -653,20 +755,12 @@ class EnhancedMultimodalAIServer:
         def search():
             """Legacy search endpoint"""
             try:
-                data = request.get_json()
+                data = _parse_json()
                 query = data.get('query', '')
                 
                 # Convert to chat format
                 prompt = f"Help with this search query: {query}. Provide relevant information and guidance."
-                chat_data = {'text': prompt}
-                
-                future = asyncio.run_coroutine_threadsafe(
-                    self._queue_and_wait('chat', chat_data, Priority.NORMAL),
-                    self.loop
-                )
-                
-                result = future.result(timeout=30)
-                self.stats["total_requests"] += 1
+                result = self._run_chat({'text': prompt}, Priority.NORMAL)
                 
                 return jsonify({
                     "results": [{"content": result.get('response', 'No results found'), "relevance": 0.9}],
@@ -677,43 +771,98 @@ class EnhancedMultimodalAIServer:
                 logger.error(f"Search error: {e}")
                 return jsonify({"error": "Search failed"}), 500
     
-    async def _queue_and_wait(self, request_type: str, data: dict, priority: Priority) -> dict:
-        """Queue request and wait for result"""
-        queue_start = time.time()
-        
-        # Create response future
-        response_future = asyncio.Future()
-        
-        # Create wrapped data with future
-        wrapped_data = {
-            **data,
-            '_response_future': response_future
-        }
+    def _run_chat(self, data: dict, priority: Priority) -> dict:
+        """Answer a chat request; the multimodal chat route and the legacy
+        text routes all share this single submission"""
+        result = self._submit('chat', data, priority)
+        if 'error' not in result:
+            self.stats["total_requests"] += 1
+        return result
+    
+    def _submit(self, request_type: str, data: dict, priority: Priority) -> dict:
+        """Queue a request from a route thread and block until the consumer
+        answers, at most route_timeout seconds"""
+        if self.is_development and DEV_DIRECT_CALLS:
+            return self._run_direct(request_type, data)
         
-        # Queue request
-        request_id = await self.request_queue.add_request(
-            request_type=request_type,
-            payload=wrapped_data,
-            priority=priority
-        )
+        queue_start = time.monotonic_ns()
         
-        if not request_id:
-            return {"error": "Queue full - server overloaded"}
+        # A thread-safe future the consumer completes directly; the route
+        # thread waits on it without another hop through the event loop
+        response_future = Future()
+        data['_response_future'] = response_future
+        asyncio.run_coroutine_threadsafe(self._enqueue(request_type, data, priority), self.loop)
         
-        # Wait for processing
-        result = await response_future
+        try:
+            result = response_future.result(timeout=self.route_timeout)
+        except FutureTimeoutError:
+            # Lets the consumer skip the request if it has not started yet
+            response_future.cancel()
+            raise
         
         # Add queue time
-        result['queue_time_ms'] = round((time.time() - queue_start - result.get('processing_time', 0)) * 1000)
+        result['queue_time_ms'] = max(
+            0, (time.monotonic_ns() - queue_start) // 1_000_000 - int(result.get('processing_time', 0) * 1000)
+        )
         
         return result
     
+    def _run_direct(self, request_type: str, data: dict) -> dict:
+        """Development fast path (DEV_DIRECT_CALLS): call the mock model in the
+        route thread, skipping the queue"""
+        try:
+            method, args = self._model_call(request_type, data)
+            result = getattr(self.model, method)(*args)
+        except Exception as e:
+            logger.error(f"Error processing {request_type} request: {e}")
+            return {"error": str(e)}
+        
+        self._record_processing_time(result['processing_time'])
+        result['queue_time_ms'] = 0
+        return result
+    
+    async def _enqueue(self, request_type: str, data: dict, priority: Priority, requeued: bool = False):
+        """Add a request to the queue, answering it right away if it is rejected"""
+        response_future = data['_response_future']
+        try:
+            request_id = await self.request_queue.add_request(
+                request_type=request_type,
+                payload=data,
+                priority=priority,
+                requeued=requeued
+            )
+        except Exception as e:
+            if not response_future.done():
+                response_future.set_exception(e)
+            return
+        
+        if not request_id:
+            if not response_future.done():
+                response_future.set_result({"error": "Queue full - server overloaded"})
+        elif priority == Priority.EMERGENCY:
+            self._preempt_running()
+    
+    async def _fail_request(self, queued_request: QueuedRequest, error: Exception):
+        """Answer a request the queue gave up on before _process_request took its future"""
+        response_future = (queued_request.payload or {}).pop('_response_future', None)
+        if response_future is not None and not response_future.done():
+            response_future.set_result({"error": str(error)})
+    
+    def _record_processing_time(self, processing_time: float):
+        """Add a processing time to the recent window"""
+        with self._stats_lock:
+            times = self.stats["processing_times"]
+            if len(times) == times.maxlen:
+                self._processing_time_sum -= times[0]
+            times.append(processing_time)
+            self._processing_time_sum += processing_time
+    
     def _calculate_avg_processing_time(self):
         """Calculate average processing time"""
-        if not self.stats["processing_times"]:
+        count = len(self.stats["processing_times"])
+        if not count:
             return 0
-        recent = self.stats["processing_times"][-100:]  # Last 100 requests
-        return round(sum(recent) / len(recent) * 1000)
+        return round(self._processing_time_sum / count * 1000)
     
     def run(self, host='0.0.0.0', port=8080, debug=False):
         """Run the enhanced server"""
@@ -721,7 +870,41 @@ class EnhancedMultimodalAIServer:
         logger.info(f"Mode: {self.stats['mode']}")
         logger.info(f"Queue: max_size={self.request_queue.max_size}, max_concurrent={self.request_queue.max_concurrent}")
         
-        self.app.run(host=host, port=port, debug=debug, threaded=True)
+        if debug:
+            self.app.run(host=host, port=port, debug=debug, threaded=True)
+            return
+        
+        # Request threads only wait on the single queue consumer, so a
+        # production WSGI server with a modest thread pool is enough
+        try:
+            from waitress import serve
+            serve(
+                self.app,
+                host=host,
+                port=port,
+                threads=self.request_queue.max_size + self.request_queue.max_concurrent,
+                channel_timeout=120,
+                # Multi-MB base64 uploads: read them in large chunks and keep
+                # them in memory instead of spilling past 512KB to a temp file
+                recv_bytes=256 * 1024,
+                inbuf_overflow=16 * 1024 * 1024,
+                send_bytes=64 * 1024
+            )
+        except ImportError:
+            logger.warning("Waitress not available, using Flask dev server")
+            self.app.run(host=host, port=port, threaded=True)
+
+def create_app():
+    """WSGI app factory, so a multi-process server builds one model per worker.
+    
+    Development (mock model, CPU-bound host work):
+        gunicorn -w 5 -k gthread --threads 8 'ai_server_multimodal_enhanced:create_app()'
+    Production (one GPU): keep a single worker and let batching share the model:
+        gunicorn -w 1 -k gthread --threads 32 'ai_server_multimodal_enhanced:create_app()'
+    
+    Queues and stats are per worker.
+    """
+    return EnhancedMultimodalAIServer().app
 
 if __name__ == "__main__":
     server = EnhancedMultimodalAIServer()
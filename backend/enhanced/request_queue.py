@@ -4,9 +4,10 @@ Advanced Request Queue System for Multimodal AI Server
 Provides priority-based processing, overflow handling, and monitoring
 """
 
+import os
 import asyncio
 import time
-import uuid
+from collections import deque
 from enum import Enum
 from typing import Dict, Any, Optional, Callable
 from dataclasses import dataclass, field
@@ -15,6 +16,12 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+# Finished QueuedRequest objects kept for reuse by each queue
+REQUEST_POOL_SIZE = 256
+
+# get_stats() results are reused for this long (seconds)
+STATS_TTL = 0.1
+
 class Priority(Enum):
     """Request priority levels"""
     EMERGENCY = 1  # Medical emergencies, safety issues
@@ -22,41 +29,135 @@ class Priority(Enum):
     NORMAL = 3     # General queries, chat
     LOW = 4        # Background tasks, analytics
 
-@dataclass
+class Requeued(Exception):
+    """Raised by a handler that put its request back in the queue (e.g. it was
+    preempted); the attempt counts as neither processed nor failed"""
+
+@dataclass(slots=True)
 class QueuedRequest:
     """Request wrapper with metadata"""
-    id: str = field(default_factory=lambda: str(uuid.uuid4()))
+    id: str = field(default_factory=lambda: os.urandom(16).hex())
     priority: Priority = Priority.NORMAL
     request_type: str = ""
     payload: Dict[str, Any] = field(default_factory=dict)
-    timestamp: float = field(default_factory=time.time)
+    timestamp: float = field(default_factory=time.monotonic)  # monotonic, for latencies only
     client_id: Optional[str] = None
     
-    def __lt__(self, other):
-        """Enable priority queue sorting"""
-        if self.priority.value != other.priority.value:
-            return self.priority.value < other.priority.value
-        return self.timestamp < other.timestamp
+    def reset(self, priority: Priority, request_type: str, payload: Dict[str, Any], client_id: Optional[str]):
+        """Reinitialize a recycled request in place, with a fresh id and timestamp"""
+        self.id = os.urandom(16).hex()
+        self.priority = priority
+        self.request_type = request_type
+        self.payload = payload
+        self.timestamp = time.monotonic()
+        self.client_id = client_id
+
+class P2Quantile:
+    """Streaming quantile estimate in O(1) memory (the P-squared algorithm of
+    Jain & Chlamtac): five markers track the minimum, the quantile, the
+    maximum and the two midpoints between them"""
+    
+    def __init__(self, p: float):
+        self.p = p
+        self.heights = []
+        self.positions = [0, 1, 2, 3, 4]
+        self.desired = [0, 2 * p, 4 * p, 2 + 2 * p, 4]
+        self.increments = [0, p / 2, p, (1 + p) / 2, 1]
+    
+    def add(self, x: float):
+        q = self.heights
+        if len(q) < 5:
+            q.append(x)
+            q.sort()
+            return
+        
+        # Cell the sample falls in, stretching the extremes if needed
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = 0
+            while x >= q[k + 1]:
+                k += 1
+        
+        n = self.positions
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+        
+        # Move the middle markers towards their desired positions
+        for i in (1, 2, 3):
+            d = self.desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                height = q[i] + d / (n[i + 1] - n[i - 1]) * (
+                    (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i])
+                    + (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1])
+                )
+                if not q[i - 1] < height < q[i + 1]:
+                    height = q[i] + d * (q[i + d] - q[i]) / (n[i + d] - n[i])
+                q[i] = height
+                n[i] += d
+    
+    def value(self) -> float:
+        q = self.heights
+        if not q:
+            return 0.0
+        if len(q) < 5:
+            return q[min(len(q) - 1, int(self.p * len(q)))]
+        return q[2]
+
+class RunningStat:
+    """Count, mean and p50/p95/p99 of a stream of samples in constant memory"""
+    
+    QUANTILES = (0.5, 0.95, 0.99)
+    
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.quantiles = [P2Quantile(q) for q in self.QUANTILES]
+    
+    def add(self, x: float):
+        self.count += 1
+        self.mean += (x - self.mean) / self.count
+        for quantile in self.quantiles:
+            quantile.add(x)
+    
+    def percentiles(self) -> Dict[str, float]:
+        return {f"p{round(q.p * 100)}": round(q.value(), 2) for q in self.quantiles}
 
 class RequestQueueStats:
-    """Queue statistics tracker"""
+    """Queue statistics tracker. The record_* methods are only called from the
+    queue's event loop, so the counters are plain ints without a lock.
+    get_stats() is called from the Flask request threads and refreshes the
+    cache there; the (time, stats) pair is swapped in with one assignment, so
+    concurrent callers at worst both rebuild it, and never see a torn entry."""
     def __init__(self):
         self.total_queued = 0
         self.total_processed = 0
         self.total_rejected = 0
         self.total_errors = 0
-        self.processing_times = []
-        self.queue_times = []
-        self.priority_counts = {p: 0 for p in Priority}
+        # Streaming summaries, so memory stays bounded however long the server runs
+        self.processing_times = RunningStat()
+        self.queue_times = RunningStat()
+        # Counts indexed by priority value - 1, next to their fixed names
+        self._priority_names = [p.name for p in Priority]
+        self.priority_counts = [0] * len(Priority)
+        # (monotonic build time, last get_stats() result)
+        self._cache = (0.0, None)
         
     def record_queued(self, priority: Priority):
         self.total_queued += 1
-        self.priority_counts[priority] += 1
+        self.priority_counts[priority.value - 1] += 1
     
     def record_processed(self, queue_time: float, processing_time: float):
         self.total_processed += 1
-        self.queue_times.append(queue_time)
-        self.processing_times.append(processing_time)
+        self.queue_times.add(queue_time)
+        self.processing_times.add(processing_time)
     
     def record_rejected(self):
         self.total_rejected += 1
@@ -65,32 +166,53 @@ class RequestQueueStats:
         self.total_errors += 1
     
     def get_stats(self) -> Dict[str, Any]:
-        """Get current statistics"""
-        avg_queue_time = sum(self.queue_times) / len(self.queue_times) if self.queue_times else 0
-        avg_processing_time = sum(self.processing_times) / len(self.processing_times) if self.processing_times else 0
+        """Get current statistics, at most STATS_TTL seconds old"""
+        now = time.monotonic()
+        cache_time, cached = self._cache
+        if cached is not None and now - cache_time < STATS_TTL:
+            return cached
         
-        return {
+        stats = {
             'total_queued': self.total_queued,
             'total_processed': self.total_processed,
             'total_rejected': self.total_rejected,
             'total_errors': self.total_errors,
-            'avg_queue_time': round(avg_queue_time, 2),
-            'avg_processing_time': round(avg_processing_time, 2),
-            'priority_breakdown': {p.name: count for p, count in self.priority_counts.items()},
+            'avg_queue_time': round(self.queue_times.mean, 2),
+            'avg_processing_time': round(self.processing_times.mean, 2),
+            'queue_time_percentiles': self.queue_times.percentiles(),
+            'processing_time_percentiles': self.processing_times.percentiles(),
+            'priority_breakdown': dict(zip(self._priority_names, self.priority_counts)),
             'success_rate': round(self.total_processed / self.total_queued * 100, 2) if self.total_queued > 0 else 0
         }
+        self._cache = (now, stats)
+        return stats
 
 class AdvancedRequestQueue:
     """Advanced request queue with priority processing and monitoring"""
     
-    def __init__(self, max_size: int = 20, max_concurrent: int = 4, overflow_policy: str = 'reject'):
+    def __init__(self, max_size: int = 20, max_concurrent: int = 4, overflow_policy: str = 'reject',
+                 request_timeout: Optional[float] = None):
         self.max_size = max_size
         self.max_concurrent = max_concurrent
         self.overflow_policy = overflow_policy  # 'reject', 'drop_oldest', 'drop_lowest_priority'
+        self.request_timeout = request_timeout  # seconds a handler may run, None for no limit
         
-        # Use asyncio PriorityQueue for automatic priority sorting
-        self.queue = asyncio.PriorityQueue(maxsize=max_size)
-        self.processing = {}  # Track active requests
+        # One FIFO per priority level plus a bitmask of the non-empty levels
+        # (bit n set <=> the level with priority value n has requests), so
+        # enqueue, dequeue and finding the lowest level are all O(1)
+        self.levels = {p.value: deque() for p in Priority}
+        self.nonempty_mask = 0
+        self.size = 0
+        self._not_empty = asyncio.Event()
+        self._closed = False
+        # One slot per concurrent request, and set while nothing is queued or running
+        self._slots = asyncio.Semaphore(max_concurrent)
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self.processing = set()  # Ids of active requests
+        # Finished requests are reused by add_request; only the event loop
+        # touches the pool, so it needs no lock
+        self._free = deque(maxlen=REQUEST_POOL_SIZE)
         self.stats = RequestQueueStats()
         
         # Callbacks for monitoring
@@ -104,84 +226,145 @@ class AdvancedRequestQueue:
                          request_type: str,
                          payload: Dict[str, Any],
                          priority: Priority = Priority.NORMAL,
-                         client_id: Optional[str] = None) -> Optional[str]:
-        """Add request to queue with priority"""
-        request = QueuedRequest(
-            priority=priority,
-            request_type=request_type,
-            payload=payload,
-            client_id=client_id
-        )
+                         client_id: Optional[str] = None,
+                         requeued: bool = False) -> Optional[str]:
+        """Add request to queue with priority; requeued requests were counted
+        as queued the first time round"""
+        if self._closed:
+            self.stats.record_rejected()
+            return None
         
-        try:
-            # Try to add to queue
-            self.queue.put_nowait((request.priority.value, request))
-            self.stats.record_queued(priority)
+        if self._free:
+            request = self._free.pop()
+            request.reset(priority, request_type, payload, client_id)
+        else:
+            request = QueuedRequest(
+                priority=priority,
+                request_type=request_type,
+                payload=payload,
+                client_id=client_id
+            )
+        
+        if self.size < self.max_size:
+            self._push(request)
+            if not requeued:
+                self.stats.record_queued(priority)
             logger.info(f"Request {request.id} queued with priority {priority.name}")
             return request.id
+        
+        # Handle overflow based on policy
+        if self.overflow_policy == 'reject':
+            self.stats.record_rejected()
+            logger.warning(f"Queue full - rejected request {request.id}")
+            if self.on_queue_full:
+                await self.on_queue_full(request)
+            self._recycle(request)
+            return None
             
-        except asyncio.QueueFull:
-            # Handle overflow based on policy
-            if self.overflow_policy == 'reject':
-                self.stats.record_rejected()
-                logger.warning(f"Queue full - rejected request {request.id}")
-                if self.on_queue_full:
-                    await self.on_queue_full(request)
-                return None
-                
-            elif self.overflow_policy == 'drop_oldest':
-                # Remove oldest item and add new one
-                await self._drop_oldest()
-                await self.queue.put((request.priority.value, request))
+        elif self.overflow_policy == 'drop_oldest':
+            # Remove oldest item and add new one
+            self._drop_oldest()
+            self._push(request)
+            if not requeued:
                 self.stats.record_queued(priority)
-                return request.id
-                
-            elif self.overflow_policy == 'drop_lowest_priority':
-                # Remove lowest priority item if new one is higher
-                dropped = await self._drop_lowest_priority(request)
-                if dropped:
-                    await self.queue.put((request.priority.value, request))
+            return request.id
+            
+        elif self.overflow_policy == 'drop_lowest_priority':
+            # Remove lowest priority item if new one is higher
+            if self._drop_lowest_priority(request):
+                self._push(request)
+                if not requeued:
                     self.stats.record_queued(priority)
-                    return request.id
-                else:
-                    self.stats.record_rejected()
-                    return None
+                return request.id
+            else:
+                self.stats.record_rejected()
+                self._recycle(request)
+                return None
+    
+    def _push(self, request: QueuedRequest):
+        """Append a request to its priority level"""
+        level = request.priority.value
+        self.levels[level].append(request)
+        self.nonempty_mask |= 1 << level
+        self.size += 1
+        self._not_empty.set()
+        self._idle.clear()
+    
+    def _recycle(self, request: QueuedRequest):
+        """Return a finished or discarded request to the pool, without keeping
+        its (possibly large) payload alive"""
+        request.payload = None
+        self._free.append(request)
+    
+    def _take(self, level: int) -> QueuedRequest:
+        """Remove the oldest request of a non-empty level"""
+        requests = self.levels[level]
+        request = requests.popleft()
+        if not requests:
+            self.nonempty_mask &= ~(1 << level)
+        self.size -= 1
+        if not self.size:
+            self._not_empty.clear()
+        return request
+    
+    def _pop(self) -> QueuedRequest:
+        """Remove the next request: oldest of the most urgent non-empty level"""
+        mask = self.nonempty_mask
+        return self._take((mask & -mask).bit_length() - 1)
     
     async def process_requests(self, handler: Callable):
         """Main processing loop - run this in background"""
         while True:
-            # Wait if at max concurrent limit
-            while len(self.processing) >= self.max_concurrent:
-                await asyncio.sleep(0.1)
+            # Wait for a free slot; finishing requests release theirs
+            await self._slots.acquire()
+            acquired = 1
+            batch = []
+            started = 0
             
             try:
                 # Get next priority request
-                priority_value, request = await self.queue.get()
+                await self._not_empty.wait()
+                batch.append(self._pop())
                 
-                # Track processing
-                self.processing[request.id] = {
-                    'request': request,
-                    'start_time': time.time()
-                }
+                # Requests that already have a free slot are taken in the same
+                # pass rather than one loop iteration each
+                while self.size and not self._slots.locked():
+                    await self._slots.acquire()
+                    acquired += 1
+                    batch.append(self._pop())
                 
-                # Process in background
-                asyncio.create_task(self._process_single(request, handler))
+                for request in batch:
+                    # Track processing, then process in background
+                    self.processing.add(request.id)
+                    asyncio.create_task(self._process_single(request, handler))
+                    started += 1
                 
             except Exception as e:
                 logger.error(f"Error in process loop: {e}")
                 self.stats.record_error()
+                # Give back every slot without a running task, and fail the
+                # requests that were taken off the queue but never started
+                for _ in range(acquired - started):
+                    self._slots.release()
+                for request in batch[started:]:
+                    self.processing.discard(request.id)
+                    if self.on_error:
+                        await self.on_error(request, e)
+                    self._recycle(request)
+                if not self.processing and not self.size:
+                    self._idle.set()
     
     async def _process_single(self, request: QueuedRequest, handler: Callable):
         """Process a single request"""
-        start_time = time.time()
+        start_time = time.monotonic()
         queue_time = start_time - request.timestamp
         
         try:
-            # Call handler
-            result = await handler(request)
+            # Call handler; a hung one is cancelled so it cannot hold its slot forever
+            result = await asyncio.wait_for(handler(request), self.request_timeout)
             
             # Record success
-            processing_time = time.time() - start_time
+            processing_time = time.monotonic() - start_time
             self.stats.record_processed(queue_time, processing_time)
             
             logger.info(f"Request {request.id} completed in {processing_time:.2f}s")
@@ -189,6 +372,16 @@ class AdvancedRequestQueue:
             if self.on_request_complete:
                 await self.on_request_complete(request, result)
                 
+        except Requeued:
+            logger.info(f"Request {request.id} went back to the queue")
+            
+        except asyncio.TimeoutError as e:
+            logger.warning(f"Request {request.id} timed out after {self.request_timeout}s")
+            self.stats.record_error()
+            
+            if self.on_error:
+                await self.on_error(request, e)
+                
         except Exception as e:
             logger.error(f"Error processing request {request.id}: {e}")
             self.stats.record_error()
@@ -197,59 +390,49 @@ class AdvancedRequestQueue:
                 await self.on_error(request, e)
                 
         finally:
-            # Remove from processing
-            self.processing.pop(request.id, None)
+            # Remove from processing and recycle the request
+            self.processing.discard(request.id)
+            self._recycle(request)
+            self._slots.release()
+            if not self.processing and not self.size:
+                self._idle.set()
     
-    async def _drop_oldest(self):
+    def _drop_oldest(self):
         """Drop oldest request from queue"""
-        # Get all items, sort by timestamp, remove oldest
-        items = []
-        while not self.queue.empty():
-            items.append(await self.queue.get())
+        if not self.size:
+            return
         
-        if items:
-            # Sort by timestamp (oldest first)
-            items.sort(key=lambda x: x[1].timestamp)
-            dropped = items.pop(0)
-            logger.warning(f"Dropped oldest request {dropped[1].id}")
-            
-            # Put back remaining items
-            for item in items:
-                await self.queue.put(item)
+        # Each level is FIFO, so the oldest request is one of the level heads
+        oldest_level = min(
+            (level for level, requests in self.levels.items() if requests),
+            key=lambda level: self.levels[level][0].timestamp
+        )
+        dropped = self._take(oldest_level)
+        logger.warning(f"Dropped oldest request {dropped.id}")
+        self._recycle(dropped)
     
-    async def _drop_lowest_priority(self, new_request: QueuedRequest) -> bool:
+    def _drop_lowest_priority(self, new_request: QueuedRequest) -> bool:
         """Drop lowest priority if new request is higher priority"""
-        items = []
-        while not self.queue.empty():
-            items.append(await self.queue.get())
-        
-        if not items:
+        if not self.size:
             return True
         
-        # Find lowest priority
-        items.sort(key=lambda x: (-x[0], x[1].timestamp))  # Sort by priority DESC, then timestamp
-        lowest = items[0]
+        # Lowest priority = highest non-empty level
+        lowest_level = self.nonempty_mask.bit_length() - 1
         
         # Check if new request is higher priority
-        if new_request.priority.value < lowest[0]:
-            # Drop lowest priority
-            items.pop(0)
-            logger.warning(f"Dropped low priority request {lowest[1].id}")
-            
-            # Put back remaining items
-            for item in items:
-                await self.queue.put(item)
+        if new_request.priority.value < lowest_level:
+            dropped = self._take(lowest_level)
+            logger.warning(f"Dropped low priority request {dropped.id}")
+            self._recycle(dropped)
             return True
-        else:
-            # Put everything back - new request is not higher priority
-            for item in items:
-                await self.queue.put(item)
-            return False
+        
+        # New request is not higher priority
+        return False
     
     def get_queue_status(self) -> Dict[str, Any]:
         """Get current queue status"""
         return {
-            'queue_size': self.queue.qsize(),
+            'queue_size': self.size,
             'processing': len(self.processing),
             'max_size': self.max_size,
             'max_concurrent': self.max_concurrent,
@@ -261,15 +444,10 @@ class AdvancedRequestQueue:
         logger.info("Shutting down request queue...")
         
         # Stop accepting new requests
-        self.max_size = 0
-        
-        # Wait for queue to empty
-        while not self.queue.empty():
-            await asyncio.sleep(0.1)
+        self._closed = True
         
-        # Wait for processing to complete
-        while self.processing:
-            await asyncio.sleep(0.1)
+        # Wait for the queue to empty and processing to complete
+        await self._idle.wait()
         
         logger.info("Request queue shutdown complete")
 
@@ -5,9 +5,15 @@ Centralized configuration for queue settings and performance tuning
 """
 
 import os
-from dataclasses import dataclass
+import json
+from dataclasses import dataclass, asdict
 from typing import Dict, Any
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 @dataclass
 class QueueConfig:
     """Queue configuration settings"""
@@ -138,10 +144,9 @@ class ConfigManager:
     @staticmethod
     def load_from_file(config_file: str) -> ServerConfig:
         """Load configuration from JSON file"""
-        import json
-        
-        with open(config_file, 'r') as f:
-            config_dict = json.load(f)
+        with open(config_file, 'rb') as f:
+            data = f.read()
+        config_dict = orjson.loads(data) if orjson is not None else json.loads(data)
         
         # Create appropriate config object
         env_type = config_dict.get('environment', 'development')
@@ -175,30 +180,17 @@ class ConfigManager:
     @staticmethod
     def save_to_file(config: ServerConfig, config_file: str):
         """Save configuration to JSON file"""
-        import json
-        
         config_dict = {
             'environment': config.__class__.__name__.replace('Config', '').lower(),
-            'host': config.host,
-            'port': config.port,
-            'debug': config.debug,
-            'memory_limit_gb': config.memory_limit_gb,
-            'max_response_cache_size': config.max_response_cache_size,
-            'enable_response_streaming': config.enable_response_streaming,
-            'log_level': config.log_level,
-            'log_file': config.log_file,
-            'queue': {
-                'max_size': config.queue.max_size,
-                'max_concurrent': config.queue.max_concurrent,
-                'overflow_policy': config.queue.overflow_policy,
-                'request_timeout': config.queue.request_timeout,
-                'queue_timeout': config.queue.queue_timeout,
-                'priority_weights': config.queue.priority_weights
-            }
+            **asdict(config)
         }
         
-        with open(config_file, 'w') as f:
-            json.dump(config_dict, f, indent=2)
+        if orjson is not None:
+            data = orjson.dumps(config_dict, option=orjson.OPT_INDENT_2)
+        else:
+            data = json.dumps(config_dict, indent=2).encode()
+        with open(config_file, 'wb') as f:
+            f.write(data)
 
 # Example configurations
 def create_camp_config() -> ServerConfig:
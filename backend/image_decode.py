@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+Image decoding for the vision endpoints
+Kept to PIL and pybase64 so decode worker processes stay small
+"""
+
+import base64
+import multiprocessing
+from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image, UnidentifiedImageError
+
+try:
+    import pybase64  # SIMD base64, much faster on multi-MB image payloads
+except ImportError:
+    pybase64 = base64
+
+# Gemma 3n's vision tower takes 896x896, so images are shrunk on the CPU
+# before they reach the processor; JPEGs are first decoded at reduced DCT
+# scale no smaller than DRAFT_SIZE
+VISION_INPUT_SIZE = (896, 896)
+DRAFT_SIZE = (1024, 1024)
+
+
+def decode_image_bytes(image_data):
+    """Decode a base64 image to an RGB PIL image (module level so worker processes can run it)"""
+    if not isinstance(image_data, str):
+        return None
+    if image_data.startswith('data:image'):
+        # partition copies the payload once; split(',') would build a list first
+        image_data = image_data.partition(',')[2]
+    image_bytes = pybase64.b64decode(image_data, validate=False)
+
+    try:
+        # Camera and scanner uploads are JPEG or PNG; naming them skips probing
+        # every other registered plugin
+        image = Image.open(BytesIO(image_bytes), formats=['JPEG', 'PNG'])
+    except UnidentifiedImageError:
+        # WEBP, GIF, BMP, ...
+        image = Image.open(BytesIO(image_bytes))
+    # libjpeg decodes straight to 1/2, 1/4 or 1/8 scale, far cheaper than a full decode
+    if image.format == 'JPEG':
+        image.draft('RGB', DRAFT_SIZE)
+    image = image.convert('RGB')
+    image.thumbnail(VISION_INPUT_SIZE, Image.LANCZOS, reducing_gap=2.0)
+    return image
+
+
+def _init_decode_worker():
+    """Load the image plugins once per worker process"""
+    Image.init()
+
+
+def start_decode_pool(max_workers):
+    """Decode worker processes, all started now rather than on the first image.
+    Spawned, as the caller may already run threads (or have CUDA initialized),
+    which a forked child could deadlock on; a spawned worker re-imports the
+    launching script, so booting them up front keeps that off the request path"""
+    pool = ProcessPoolExecutor(
+        max_workers=max_workers,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=_init_decode_worker
+    )
+    # Spawn pools only add a worker when none is idle, so one no-op per worker
+    # boots all of them; they come up in the background
+    for _ in range(max_workers):
+        pool.submit(int)
+    return pool